@@ -0,0 +1,82 @@
+import numpy as np
+
+from velocity_control import compute_step, record_step, clip_norm, V_MAX, R_REP, R_ATT, K_REP, K_ATT, K_TARGET
+
+# Second order counterpart of velocity_control.append_vel_pos: v_des from the same field is tracked through a
+# bounded acceleration a = clip(K_V*(v_des - v), A_MAX), recorded as Agent.a, and (p, v) are advanced by one of
+# INTEGRATORS over the whole (N, 2) arrays. Verlet and RK4 re-evaluate v_des at their intermediate positions,
+# costing 2 and 4 field evaluations per step, in exchange for staying stable and accurate at larger map.dt.
+
+A_MAX           = 20.0      # bound on |a|
+K_V             = 10.0      # velocity tracking gain, 1/K_V is the time constant of v following v_des
+INTEGRATOR      = "verlet"
+MAX_SUBSTEPS    = 64        # cap on the sub-steps of the adaptive integrator
+
+def compute_acc(v, v_des, k_v=K_V, a_max=A_MAX):
+    return clip_norm(k_v * (v_des - v), a_max)
+
+# Integrators: (p, v, t, dt, accel, a0) -> (p, v) after dt, where accel(p, v, t) is the acceleration
+# field and a0 = accel(p, v, t) has already been evaluated by the caller
+def semi_implicit_euler(p, v, t, dt, accel, a0):
+    v = v + a0*dt
+    return p + v*dt, v
+
+def velocity_verlet(p, v, t, dt, accel, a0):
+    p_new = p + v*dt + 0.5*a0*dt**2
+    a1 = accel(p_new, v + a0*dt, t + dt)     # a depends on v, which is predicted with a0
+    return p_new, v + 0.5*(a0 + a1)*dt
+
+def rk4(p, v, t, dt, accel, a0):
+    v2 = v + 0.5*dt*a0
+    a2 = accel(p + 0.5*dt*v, v2, t + 0.5*dt)
+    v3 = v + 0.5*dt*a2
+    a3 = accel(p + 0.5*dt*v2, v3, t + 0.5*dt)
+    v4 = v + dt*a3
+    a4 = accel(p + dt*v3, v4, t + dt)
+    return p + dt/6*(v + 2*v2 + 2*v3 + v4), v + dt/6*(a0 + 2*a2 + 2*a3 + a4)
+
+INTEGRATORS = {"euler": semi_implicit_euler, "verlet": velocity_verlet, "rk4": rk4}
+
+def substeps(integrator, p, v, t, dt, accel, a0, n):
+    h = dt / n
+    for k in range(n):
+        p, v = integrator(p, v, t + k*h, h, accel, a0 if k == 0 else accel(p, v, t + k*h))
+    return p, v
+
+def adaptive(integrator, p, v, t, dt, accel, a0, tol, max_substeps=MAX_SUBSTEPS):
+    """ Step doubling: the number of sub-steps doubles until halving them once more moves no position or
+        velocity by more than tol, or max_substeps is reached """
+    n, coarse = 1, integrator(p, v, t, dt, accel, a0)
+    while True:
+        fine = substeps(integrator, p, v, t, dt, accel, a0, 2*n)
+        n *= 2
+        error = max(np.max(np.abs(fine[0] - coarse[0]), initial=0), np.max(np.abs(fine[1] - coarse[1]), initial=0))
+        if error <= tol or n >= max_substeps:
+            return fine
+        coarse = fine
+
+def integrate_acc(map, t_idx, v_des, integrator=INTEGRATOR, k_v=K_V, a_max=A_MAX, tol=None, gains=None,
+                  cell_list=None, backend=None):
+    """ (p, v, a) of step t_idx + 1 from the recorded state of step t_idx, a being the acceleration applied
+        at its start. With tol, the step is split adaptively (see adaptive) """
+    traj, gains = map.trajectory, gains or {}
+    p, v, t = traj.row("p", t_idx), traj.row("v", t_idx), t_idx * map.dt
+    def accel(p, v, t):
+        v_des = compute_step(map, t_idx, **gains, cell_list=cell_list, backend=backend, positions=p, time=t)[-1]
+        return compute_acc(v, v_des, k_v, a_max)
+    a0 = compute_acc(v, v_des, k_v, a_max)
+    integrator = INTEGRATORS[integrator]
+    if tol is None:
+        p, v = integrator(p, v, t, map.dt, accel, a0)
+    else:
+        p, v = adaptive(integrator, p, v, t, map.dt, accel, a0, tol)
+    map.stats.active().lap("integration")
+    return p, v, a0
+
+def append_acc_pos(map, t=-1, integrator=INTEGRATOR, k_v=K_V, a_max=A_MAX, tol=None, v_max=V_MAX, r_rep=R_REP,
+                   r_att=R_ATT, k_rep=K_REP, k_att=K_ATT, k_target=K_TARGET, cell_list=None, backend=None):
+    t_idx = t if t >= 0 else map.trajectory.n_steps
+    gains = dict(v_max=v_max, r_rep=r_rep, r_att=r_att, k_rep=k_rep, k_att=k_att, k_target=k_target)
+    step = compute_step(map, t_idx, **gains, cell_list=cell_list, backend=backend)
+    p, v, a = integrate_acc(map, t_idx, step[-1], integrator, k_v, a_max, tol, gains, cell_list, backend)
+    record_step(map, p, *step, v=v, a=a)
@@ -0,0 +1,284 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import tempfile
+import time
+
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.animation import PillowWriter
+
+from classes import Map
+from ensemble import Ensemble
+from export import render_job, FIGSIZE, DPI
+from initialize_map import modify_map, generate_obstacles, generate_agents
+from plots import animate_map
+from velocity_control import append_vel_pos, compute_diffs_dists_com, get_obstacle_field, numba_kernels, BACKEND, R_REP
+from acceleration_control import append_acc_pos, INTEGRATORS
+
+# Run from the repository root:
+#   python -m benchmarks.run                                   quick matrix, table on stdout
+#   python -m benchmarks.run --full --out results.json         N up to 10^4, history up to 10^4
+#   python -m benchmarks.run --baseline benchmarks/baseline.json --save
+# Every case reports the median and min over --repeat timings. With --baseline, cases more than
+# --tolerance slower than the stored median are reported and the exit code is 1. Independently of
+# any baseline, step cases that differ only in history length are compared with each other, so a
+# step whose cost grows with the number of recorded steps is caught on any machine.
+
+SEED            = 0
+REPEAT          = 5
+STEPS           = 20        # steps timed per repeat in the step cases
+FRAMES          = 50        # frames timed per repeat in the render cases
+TOLERANCE       = 0.3       # allowed relative slowdown against the baseline median
+HISTORY_RATIO   = 1.5       # allowed step time ratio between the longest and the shortest history
+AREA_PER_AGENT  = 0.5       # map area per agent and per obstacle, keeps every case well inside the
+AREA_PER_OBST   = 2.5       # densities the rejection samplers in initialize_map can fill
+
+BACKENDS = ("numpy", "numba") if numba_kernels is not None else ("numpy",)
+
+QUICK = {"init":    [dict(n_agents=n, n_obstacles=o) for n in (10, 100, 1000) for o in (0, 10)],
+         "step":    [dict(n_agents=n, n_obstacles=o, n_groups=1, history=0) for n in (10, 100, 1000) for o in (0, 10)]
+                  + [dict(n_agents=100, n_obstacles=10, n_groups=4, history=0)]
+                  + [dict(n_agents=n, n_obstacles=10, n_groups=1, history=0, backend=b) for n in (100, 1000) for b in BACKENDS]
+                  + [dict(n_agents=100, n_obstacles=10, n_groups=1, history=0, integrator=i) for i in INTEGRATORS]
+                  + [dict(n_agents=100, n_obstacles=10, n_groups=1, history=h) for h in (1000, 10000)]
+                  + [dict(n_agents=100, n_obstacles=o, n_groups=1, history=0, field_resolution=0.05) for o in (10, 50)],
+         "diffs":   [dict(n_agents=n) for n in (10, 100, 1000)],
+         "field":   [dict(n_obstacles=o, field_resolution=0.05) for o in (10, 50)],
+         "ensemble": [dict(n_maps=32, n_agents=50, n_obstacles=5, backend=b) for b in BACKENDS],
+         "animate": [dict(n_agents=100, n_obstacles=10)],
+         "export":  [dict(n_agents=100, n_obstacles=10)]}
+
+FULL = {"init":    [dict(n_agents=n, n_obstacles=o) for n in (10, 100, 1000, 10000) for o in (0, 10, 50)],
+        "step":    [dict(n_agents=n, n_obstacles=o, n_groups=g, history=0)
+                    for n in (10, 100, 1000, 10000) for o in (0, 10, 50) for g in (1, 4)]
+                 + [dict(n_agents=n, n_obstacles=10, n_groups=1, history=0, backend=b)
+                    for n in (100, 1000, 10000) for b in BACKENDS]
+                 + [dict(n_agents=n, n_obstacles=10, n_groups=1, history=0, integrator=i)
+                    for n in (100, 1000) for i in INTEGRATORS]
+                 + [dict(n_agents=n, n_obstacles=10, n_groups=1, history=h) for n in (100, 1000) for h in (1000, 10000)]
+                 + [dict(n_agents=n, n_obstacles=o, n_groups=1, history=0, field_resolution=0.05)
+                    for n in (100, 1000) for o in (0, 10, 50)],
+        "diffs":   [dict(n_agents=n) for n in (10, 100, 1000, 3000)],
+        "field":   [dict(n_obstacles=o, field_resolution=r) for o in (10, 50, 200) for r in (0.05, 0.02)],
+        "ensemble": [dict(n_maps=m, n_agents=n, n_obstacles=5, backend=b)
+                     for m, n in ((32, 50), (256, 50), (32, 200)) for b in BACKENDS],
+        "animate": [dict(n_agents=n, n_obstacles=10) for n in (100, 1000)],
+        "export":  [dict(n_agents=n, n_obstacles=10) for n in (100, 1000, 10000)]}
+
+def case_id(bench, params):
+    return bench + "[" + ",".join(f"{k}={v}" for k, v in params.items()) + "]"
+
+def map_side(n_agents, n_obstacles=0):
+    return max(2.0, np.sqrt(AREA_PER_AGENT*n_agents), np.sqrt(AREA_PER_OBST*n_obstacles))
+
+def make_map(n_agents, n_obstacles=0, n_groups=1, field_resolution=None):
+    side = map_side(n_agents, n_obstacles)
+    map = Map(n_agents=n_agents, n_obstacles=n_obstacles, len_x=side, len_y=side, seed=SEED,
+              field_resolution=field_resolution)
+    with contextlib.redirect_stdout(io.StringIO()):
+        modify_map(map, a=False)
+        modify_map(map, a=True)
+        generate_obstacles(map)
+        generate_agents(map)
+    map.agents.set("group", slice(None), np.arange(len(map.agents)) % n_groups)
+    return map
+
+def fill_history(map, n):
+    """ Pretend n steps were already recorded: every field gets n copies of a row """
+    traj = map.trajectory
+    if n == 0:
+        return
+    append_vel_pos(map)
+    for name in list(traj.data):
+        row = traj.row(name, -1)
+        length = n + traj.lengths[name] - 1     # p and v also hold the initial row
+        traj.reserve(name, row.shape, length)[:length] = row
+        traj.lengths[name] = length
+
+def timed(fn, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        t0 = time.perf_counter()
+        fn(arg)
+        times.append(time.perf_counter() - t0)
+    return times
+
+def bench_init(params, repeat):
+    """ Seconds per init_map, also split into its phases """
+    phases = {"modify_map": [], "generate_obstacles": [], "generate_agents": []}
+    for _ in range(repeat):
+        side = map_side(**params)
+        map = Map(len_x=side, len_y=side, seed=SEED, **params)
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            modify_map(map, a=False)
+            modify_map(map, a=True)
+            t1 = time.perf_counter()
+            generate_obstacles(map)
+            t2 = time.perf_counter()
+            generate_agents(map)
+            t3 = time.perf_counter()
+        for phase, dt in zip(phases, (t1 - t0, t2 - t1, t3 - t2)):
+            phases[phase].append(dt)
+    total = [sum(ts) for ts in zip(*phases.values())]
+    return total, "s", {phase: float(np.median(ts)) for phase, ts in phases.items()}
+
+def bench_step(params, repeat):
+    """ Seconds per append_vel_pos after `history` recorded steps, with the default or the given backend,
+        or per append_acc_pos with the given integrator """
+    params = dict(params)
+    history, backend = params.pop("history"), params.pop("backend", None)
+    integrator = params.pop("integrator", None)
+    map = make_map(**params)
+    fill_history(map, history)
+    def step():
+        if integrator is None:
+            append_vel_pos(map, backend=backend)
+        else:
+            append_acc_pos(map, integrator=integrator, backend=backend)
+    def steps(_):
+        for _ in range(STEPS):
+            step()
+    step()     # warm up, includes loading or compiling numba kernels
+    return [t/STEPS for t in timed(steps, repeat)], "s/step", {}
+
+def bench_diffs(params, repeat):
+    map = make_map(params["n_agents"])
+    _, group_idx, counts = map.group_index()
+    return timed(lambda _: compute_diffs_dists_com(map.all_agents, group_idx, counts, 0), repeat), "s", {}
+
+def bench_field(params, repeat):
+    """ Seconds per build of the precomputed obstacle repulsion of a map with 10 agents """
+    map = make_map(10, **params)
+    def build(_):
+        map.obstacle_field = None
+        get_obstacle_field(map, R_REP)
+    return timed(build, repeat), "s", {}
+
+def bench_ensemble(params, repeat):
+    """ Seconds per Ensemble.step of n_maps maps together """
+    params = dict(params)
+    n_maps, backend = params.pop("n_maps"), params.pop("backend")
+    ens = Ensemble([make_map(**params) for _ in range(n_maps)])
+    def steps(_):
+        ens.step(STEPS, backend=backend)
+    ens.step(backend=backend)
+    return [t/STEPS for t in timed(steps, repeat)], "s/step", {}
+
+def recorded_map(params):
+    map = make_map(**params)
+    for _ in range(FRAMES):
+        append_vel_pos(map)
+    return map
+
+def bench_animate(params, repeat):
+    """ Seconds per frame of animate_map saved through save_anim's PillowWriter """
+    map = recorded_map(params)
+    def save(path):
+        anim = animate_map(map, downscale=False)
+        anim.save(path, writer=PillowWriter(fps=30))
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "anim.gif")
+        return [t/FRAMES for t in timed(save, repeat, setup=lambda: path)], "s/frame", {}
+
+def bench_export(params, repeat):
+    """ Seconds per frame rasterised by one export worker, without encoding """
+    map = recorded_map(params)
+    static = {"obstacle_bounds": np.array(map.obstacle_bounds), "radii": map.agents["r"],
+              "rectangle": (map.x_min, map.y_min, map.x_max, map.y_max), "figsize": FIGSIZE, "dpi": DPI}
+    job = (static, map.trajectory["p"][:FRAMES], map.C_O_M[:FRAMES])
+    return [t/FRAMES for t in timed(lambda _: render_job(job), repeat)], "s/frame", {}
+
+BENCHMARKS = {"init": bench_init, "step": bench_step, "diffs": bench_diffs, "field": bench_field, "ensemble": bench_ensemble,
+              "animate": bench_animate, "export": bench_export}
+
+def run(matrix, repeat=REPEAT, only=None):
+    results = {}
+    for bench, cases in matrix.items():
+        if only and bench not in only:
+            continue
+        for params in cases:
+            times, unit, extra = BENCHMARKS[bench](params, repeat)
+            key = case_id(bench, params)
+            results[key] = {"bench": bench, "params": params, "unit": unit, "median": float(np.median(times)),
+                            "min": float(np.min(times)), "repeat": repeat, **({"phases": extra} if extra else {})}
+            print(f"{key:<60} {results[key]['median']:.3e} {unit}")
+    return results
+
+def machine_info():
+    return {"python": platform.python_version(), "numpy": np.__version__, "matplotlib": matplotlib.__version__,
+            "platform": platform.platform(), "processor": platform.processor(), "cpu_count": os.cpu_count(),
+            "default_backend": BACKEND}
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """ Cases slower than the baseline median by more than tolerance, as (case, ratio) """
+    regressions = []
+    for key, result in results.items():
+        if key in baseline:
+            ratio = result["median"] / baseline[key]["median"]
+            print(f"{key:<60} {ratio:6.2f}x")
+            if ratio > 1 + tolerance:
+                regressions.append((key, ratio))
+    return regressions
+
+def history_scaling(results, max_ratio=HISTORY_RATIO):
+    """ Step cases whose time per step grows with the recorded history, as (case, ratio) """
+    groups = {}
+    for key, result in results.items():
+        if result["bench"] == "step":
+            params = dict(result["params"])
+            history = params.pop("history")
+            groups.setdefault(case_id("step", params), []).append((history, result))
+    flagged = []
+    for cases in groups.values():
+        if len(cases) > 1:
+            cases.sort(key=lambda c: c[0])
+            (_, short), (_, long) = cases[0], cases[-1]
+            ratio = long["median"] / short["median"]
+            if ratio > max_ratio:
+                flagged.append((case_id("step", long["params"]), ratio))
+    return flagged
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark map initialisation, stepping and rendering")
+    parser.add_argument("--full", action="store_true", help="run the full matrix (N up to 10^4)")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), default=None)
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--out", default=None, help="write the results to this JSON file")
+    parser.add_argument("--baseline", default=None, help="JSON file written by an earlier run")
+    parser.add_argument("--save", action="store_true", help="store the results as the new --baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    results = run(FULL if args.full else QUICK, args.repeat, args.only)
+    report = {"machine": machine_info(), "results": results}
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=1)
+
+    failed = False
+    flagged = history_scaling(results)
+    for key, ratio in flagged:
+        print(f"Step time grows with history: {key} is {ratio:.2f}x the shortest history")
+    failed |= bool(flagged)
+    if args.baseline and os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for key, ratio in regressions:
+            print(f"Regression: {key} is {ratio:.2f}x the baseline")
+        failed |= bool(regressions)
+    elif args.baseline and args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=1)
+        print("Baseline saved as", args.baseline)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,6 +1,10 @@
+import json
+
 import numpy as np
 
-from target_points import target_point
+from instrumentation import StepStats
+from spatial import ObstacleGrid
+from target_points import Targets
 
 # Global constants
 DRONE_SIZE                      = 0.2
@@ -9,6 +13,15 @@ MAX_OBSTACLE_NON_ACC_RATE       = 0.5
 MAX_OBSTACLE_OCCUPATION_RATE    = 0.2
 D_MIN_SCALE                     = 1.5
 DT                              = 0.01
+TRAJ_CAPACITY                   = 1024
+STREAM_WINDOW                   = 1024
+STREAM_CHUNK                    = 256
+AGENT_FIELDS                    = ("p", "v", "p_target", "v_target", "v_field", "v_des", "a")
+STATE_FIELDS                    = ("p", "v")    # fields that also hold the initial row
+CHECKPOINT_MAGIC                = b"SWCK1"
+CHECKPOINT_ATTRS                = ("fixed_map_size", "map_walls", "d_signed", "dt", "field_resolution", "n_agents",
+                                   "n_obstacles", "n_obstacles_walls_excluded",
+                                   "x_min", "y_min", "x_max", "y_max", "len_x", "len_y", "len_x_obst", "len_y_obst")
 
 # Default values
 n_a, n_o = 10, 0
@@ -16,23 +29,223 @@ l_x, l_y = 1, 1
 x_m, y_m = 0, 0
 x_M, y_M = None, None
 
+class Trajectory:
+    """ Preallocated (T, N, 2) history of every per-step quantity, grown by doubling. Row k holds step
+        start + k; start is above 0 for a history restarted from a Map.checkpoint, whose first C_O_M row
+        (the target origin) is then kept in first """
+    def __init__(self, init_positions, capacity=TRAJ_CAPACITY, init_velocities=None, start=0, first=None):
+        init_positions = np.asarray(init_positions, dtype=float).reshape(-1, 2)
+        self.n_agents = len(init_positions)
+        self.capacity = capacity
+        self.start, self.first = start, dict(first or {})
+        self.data, self.lengths = {}, {}
+        self.append("p", init_positions)
+        self.append("v", np.zeros_like(init_positions) if init_velocities is None else init_velocities)
+
+    @classmethod
+    def from_arrays(cls, arrays, capacity=TRAJ_CAPACITY, start=0, first=None):
+        """ Wrap existing (T, ...) arrays, e.g. memory-mapped ones; they are only copied if appended to """
+        traj = cls.__new__(cls)
+        traj.n_agents = arrays["p"].shape[1]
+        traj.capacity = capacity
+        traj.start, traj.first = start, dict(first or {})
+        traj.data = dict(arrays)
+        traj.lengths = {name: len(values) for name, values in arrays.items()}
+        return traj
+
+    @property
+    def n_steps(self):
+        return self.start + self.lengths["p"] - 1
+
+    def __getitem__(self, name):
+        if name not in self.data:
+            return np.empty((0, self.n_agents, 2))
+        return self.data[name][:self.lengths[name]]
+
+    def reserve(self, name, shape, n):
+        buf = self.data.get(name)
+        if buf is None:
+            self.data[name] = np.empty((max(n, self.capacity),) + tuple(shape))
+            self.lengths[name] = 0
+        elif n > len(buf) or not buf.flags.writeable:    # load_map memmaps are read-only, copied on first write
+            new_buf = np.empty((max(n, 2*len(buf)) if n > len(buf) else len(buf),) + buf.shape[1:])
+            new_buf[:self.lengths[name]] = buf[:self.lengths[name]]
+            self.data[name] = new_buf
+        return self.data[name]
+
+    def append(self, name, values):
+        values = np.asarray(values, dtype=float)
+        n = self.lengths.get(name, 0)
+        buf = self.reserve(name, values.shape, n+1)
+        buf[n] = values
+        self.lengths[name] = n+1
+
+    def local(self, name, t):
+        """ Buffer row holding global step t of a field (negative t counts from the end) """
+        return t - self.start if t >= 0 else t
+
+    def row(self, name, t):
+        return self[name][self.local(name, t)]
+
+    def first_row(self, name, default=None):
+        """ Row of the first step ever recorded for name, default while there is none """
+        if name in self.first:
+            return self.first[name]
+        return self[name][0] if name in self.data else default
+
+    def truncate(self, t):
+        """ Drop every step after t, leaving the state of step t last. O(1), the rows are overwritten by later appends """
+        for name in self.lengths:
+            self.lengths[name] = min(self.lengths[name], t - self.start + (name in STATE_FIELDS))
+
+    def agent_view(self, name, i):
+        return self[name][:, i, :].T   # (2, T) view, same layout as the old Agent arrays
+
+    def assign(self, name, i, values):
+        """ Overwrite the recorded rows of agent i; all agents share one length, so it cannot change here """
+        values = np.asarray(values, dtype=float).reshape(2, -1)
+        n = self.lengths.get(name, 0)
+        if values.shape[1] != n:
+            raise ValueError(f"{name} of one agent can only be rewritten with its {n} recorded steps, "
+                             f"got {values.shape[1]}")
+        if name in self.data:
+            self.reserve(name, self.data[name].shape[1:], n)
+        self[name][:, i, :] = values.T
+
+class StreamingTrajectory(Trajectory):
+    """ Keeps only the last `window` steps of each field in RAM and hands every `flush_every` new rows
+        to sink(name, rows), e.g. a storage.StreamWriter """
+    def __init__(self, init_positions, sink, window=STREAM_WINDOW, flush_every=STREAM_CHUNK):
+        self.sink, self.window, self.flush_every = sink, window, flush_every
+        self.offsets, self.flushed, self.first = {}, {}, {}
+        super().__init__(init_positions, capacity=window + flush_every)
+
+    @property
+    def n_steps(self):
+        return self.total("p") - 1
+
+    def total(self, name):
+        return self.offsets.get(name, 0) + self.lengths.get(name, 0)
+
+    def local(self, name, t):
+        if t < 0:
+            return t
+        if t < self.offsets[name]:
+            raise IndexError(f"step {t} of {name} is no longer in memory (window starts at {self.offsets[name]})")
+        return t - self.offsets[name]
+
+    def first_row(self, name, default=None):
+        return self.first.get(name, default)
+
+    def append(self, name, values):
+        if name not in self.data:
+            self.offsets[name], self.flushed[name] = 0, 0
+            self.first[name] = np.array(values, dtype=float)
+        elif self.lengths[name] == len(self.data[name]):
+            self.flush(name)
+            buf, n = self.data[name], self.lengths[name]
+            buf[:self.window] = buf[n-self.window:n]
+            self.lengths[name] = self.window
+            self.offsets[name] += n - self.window
+        super().append(name, values)
+        if self.total(name) - self.flushed[name] >= self.flush_every:
+            self.flush(name)
+
+    def flush(self, name=None):
+        for name in ([name] if name is not None else list(self.data)):
+            start = self.flushed[name] - self.offsets[name]
+            if start < self.lengths[name]:
+                if self.sink is None:
+                    raise ValueError("the stream of this trajectory was stopped, new steps cannot be written")
+                self.sink(name, self[name][start:].copy())
+                self.flushed[name] = self.total(name)
+
+class Records:
+    """ Rows of fixed-size typed columns in contiguous arrays, grown by doubling so appends are amortised O(1).
+        Writes through set() or the Agent/Obstacle views bump version, which caches such as Map.group_index check """
+    def __init__(self, columns, capacity=16):
+        self.data = {name: np.empty((capacity,) + shape, dtype=dtype) for name, (dtype, shape) in columns.items()}
+        self.n = 0
+        self.version = 0
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, name):
+        return self.data[name][:self.n]
+
+    def reserve(self, n):
+        for name, buf in self.data.items():
+            if n > len(buf):
+                new_buf = np.empty((max(n, 2*len(buf)),) + buf.shape[1:], dtype=buf.dtype)
+                new_buf[:self.n] = buf[:self.n]
+                self.data[name] = new_buf
+
+    def append(self, **values):
+        return self.extend(1, **values)
+
+    def extend(self, n, **values):
+        """ Add n rows, each value is broadcast over them; returns the index of the first new row """
+        self.reserve(self.n + n)
+        for name, value in values.items():
+            self.data[name][self.n:self.n+n] = value
+        self.n += n
+        self.version += 1
+        return self.n - n
+
+    def set(self, name, idx, value):
+        self[name][idx] = value
+        self.version += 1
+
+    def clear(self):
+        self.n = 0
+        self.version += 1
+
+AGENT_COLUMNS       = {"id": (np.int64, ()), "group": (np.int64, ()), "r": (float, ())}
+OBSTACLE_COLUMNS    = {"id": (object, ()), "bounds": (float, (4,))}    # walls have string ids
+
+def record_field(name, col=None):
+    def fget(self):
+        return self.records.data[name][self.idx] if col is None else self.records.data[name][self.idx, col]
+    def fset(self, value):
+        self.records.set(name, self.idx if col is None else (self.idx, col), value)
+    return property(fget, fset)
+
+def trajectory_field(name):
+    def fget(self):
+        return self.traj.agent_view(name, self.idx)
+    def fset(self, value):
+        self.traj.assign(name, self.idx, value)
+    return property(fget, fset)
+
 class Agent:
-    def __init__(self, id=0, group=0, r=DRONE_SIZE/2, 
-                 p=np.array([[0],[0]]), v=np.array([[0],[0]]), a=np.array([[0],[0]])):
-        self.id = id
-        self.group = group
-        self.r = r
-        self.p,self.v,self.a = p,v,a
-        self.p_field,self.v_field = np.array([[],[]]),np.array([[],[]])
-        self.p_target,self.v_target = np.array([[],[]]),np.array([[],[]])
-        self.p_des,self.v_des = np.array([[],[]]),np.array([[],[]])
+    """ View of row idx of a Map's agent records and trajectory """
+    __slots__ = ("records", "idx", "traj")
+    id, group, r = record_field("id"), record_field("group"), record_field("r")
+    p, v = trajectory_field("p"), trajectory_field("v")
+    p_target, v_target = trajectory_field("p_target"), trajectory_field("v_target")
+    v_field, v_des = trajectory_field("v_field"), trajectory_field("v_des")
+    a = trajectory_field("a")     # only recorded by acceleration_control
+
+    def __init__(self, records, idx, traj=None):
+        self.records, self.idx, self.traj = records, idx, traj
 
 class Obstacle:
-    def __init__(self, id=0, x_min=0, y_min=0, x_max=0, y_max=0):
-        self.id = id
-        self.x_min, self.y_min = x_min, y_min
-        self.x_max, self.y_max = x_max, y_max
-        self.len_x, self.len_y = x_max-x_min, y_max-y_min
+    """ View of row idx of a Map's obstacle records """
+    __slots__ = ("records", "idx")
+    id = record_field("id")
+    x_min, y_min = record_field("bounds", 0), record_field("bounds", 1)
+    x_max, y_max = record_field("bounds", 2), record_field("bounds", 3)
+
+    def __init__(self, records, idx):
+        self.records, self.idx = records, idx
+
+    @property
+    def len_x(self):
+        return self.x_max - self.x_min
+    @property
+    def len_y(self):
+        return self.y_max - self.y_min
 
 class Map:
     @property
@@ -51,8 +264,13 @@ class Map:
     def a_free(self):
         return self.a_map_acc - self.a_obst_non_acc
     @property
+    def a_obst_packed(self):
+        return self.n_obstacles_walls_excluded * (self.len_x_obst + self.d_min_oo) * (self.len_y_obst + self.d_min_oo)
+    @property
     def p_ob_rate(self):
-        ob_occupation_rate = self.a_obst_non_acc / self.a_map if self.a_map > 0 else 0
+        # Obstacles padded by d_min_oo/2 on every side may not overlap and, with walls, must stay d_min_oo/2
+        # inside them; without walls they may reach d_min_oo/2 past the edges. Either way that is a_map_acc
+        ob_occupation_rate = self.a_obst_packed / self.a_map_acc if self.a_map_acc > 0 else 0
         return ob_occupation_rate / MAX_OBSTACLE_NON_ACC_RATE
     @property
     def p_ag_rate(self):
@@ -60,19 +278,50 @@ class Map:
         ag_occupation_rate = a_agents / self.a_free if self.a_free > 0 else 0
         return ag_occupation_rate / MAX_AGENT_OCCUPATION_RATE
     
+    @property
+    def C_O_M(self):
+        return self.trajectory["C_O_M"] if self.trajectory is not None else np.array([])
+
+    @property
+    def obstacle_bounds(self):
+        return self.obstacles["bounds"]
+
+    @property
+    def all_agents(self):
+        """ Agent views of every agent row, rebuilt only when rows are added or removed """
+        if len(self.agent_views) != len(self.agents):
+            self.agent_views = np.empty(len(self.agents), dtype=object)
+            self.agent_views[:] = [Agent(self.agents, i, self.trajectory) for i in range(len(self.agents))]
+        return self.agent_views
+
+    @property
+    def all_obstacles(self):
+        if len(self.obstacle_views) != len(self.obstacles):
+            self.obstacle_views = np.empty(len(self.obstacles), dtype=object)
+            self.obstacle_views[:] = [Obstacle(self.obstacles, k) for k in range(len(self.obstacles))]
+        return self.obstacle_views
+
     @property
     def all_groups(self):
-        groups = np.unique([a.group for a in self.all_agents])
-        return groups
+        return self.group_index()[0]
+
+    def group_index(self):
+        """ (groups, group_idx, counts): sorted group ids, the row of each agent in groups and the size
+            of each group. Cached until the agent records change """
+        version = (self.agents, self.agents.version)
+        if self.groups_cache is None or self.groups_cache[0] != version:
+            groups, group_idx, counts = np.unique(self.agents["group"], return_inverse=True, return_counts=True)
+            self.groups_cache = (version, (groups, group_idx, counts))
+        return self.groups_cache[1]
     
     def __init__(self, fixed_map_size=False, map_walls=False, n_agents=n_a, n_obstacles=n_o, dt=DT,
-                 len_x=l_x, len_y=l_y, x_min=x_m, y_min=y_m, x_max=x_M, y_max=y_M):
+                 len_x=l_x, len_y=l_y, x_min=x_m, y_min=y_m, x_max=x_M, y_max=y_M, seed=None, field_resolution=None):
 
         self.fixed_map_size = fixed_map_size
         self.map_walls = map_walls
         self.dt = dt
-        self.d_min_aa = D_MIN_SCALE * 2 * Agent().r
-        self.d_min_ao = self.d_min_aa - Agent().r
+        self.d_min_aa = D_MIN_SCALE * DRONE_SIZE
+        self.d_min_ao = self.d_min_aa - DRONE_SIZE/2
         self.d_min_oo = self.d_min_aa
         self.d_signed = -self.d_min_aa if self.map_walls else self.d_min_aa
         self.n_obstacles_walls_excluded = n_obstacles
@@ -91,6 +340,117 @@ class Map:
         a_obst = a_obsts / self.n_obstacles_walls_excluded if self.n_obstacles_walls_excluded else 0
         self.len_x_obst, self.len_y_obst = np.sqrt(a_obst), np.sqrt(a_obst)
 
-        self.all_agents = np.array([])
-        self.all_obstacles = np.array([])
-        self.C_O_M = np.array([])
\ No newline at end of file
+        self.seed_rng(seed)
+
+        self.agents = Records(AGENT_COLUMNS)
+        self.obstacles = Records(OBSTACLE_COLUMNS)
+        self.agent_views = self.obstacle_views = np.empty(0, dtype=object)
+        self.init_positions_array = np.empty((0, 2))
+        self.obstacle_index = None
+        self.field_resolution = field_resolution    # grid cell of the precomputed obstacle repulsion, None for exact
+        self.obstacle_field = None
+        self.trajectory = None
+        self.stats = StepStats()
+        self.events = None      # collisions.EventLog checking every recorded step, if attached
+        self.targets = Targets()
+        self.groups_cache = None
+
+    def seed_rng(self, seed=None):
+        """ seed may be an int, a np.random.Generator or None (fresh entropy, kept in self.seed to replay the map) """
+        if isinstance(seed, np.random.Generator):
+            self.seed, self.rng = None, seed
+        else:
+            self.seed = int(np.random.SeedSequence().entropy) if seed is None else seed
+            self.rng = np.random.default_rng(self.seed)
+
+    def build_obstacle_index(self):
+        cell_size = max(self.len_x_obst, self.len_y_obst, self.d_min_oo)
+        self.obstacle_index = ObstacleGrid(self.x_min, self.y_min, self.x_max, self.y_max, cell_size)
+        for rect in self.obstacle_bounds:
+            self.obstacle_index.insert(rect)
+        self.obstacle_field = None
+        return self.obstacle_index
+
+    def add_obstacle(self, id, bounds):
+        """ Append an obstacle row and keep the obstacle index, if built, in sync """
+        k = self.obstacles.append(id=id, bounds=bounds)
+        if self.obstacle_index is not None:
+            self.obstacle_index.insert(bounds)
+        self.obstacle_field = None
+        return k
+
+    def init_trajectory(self):
+        self.attach_trajectory(Trajectory(self.init_positions_array))
+
+    def attach_trajectory(self, trajectory):
+        self.trajectory = trajectory
+        self.agent_views = np.empty(0, dtype=object)     # rebuilt on the next all_agents, bound to trajectory
+
+    def checkpoint(self, t=None):
+        """ The state at recorded step t (default: the last) as one binary blob for restore(): positions,
+            velocities, target origins, agent and obstacle records, map geometry, RNG state and the step """
+        traj = self.trajectory
+        t = traj.n_steps if t is None else t
+        header = {"step": int(t), "seed": self.seed, "rng": self.rng.bit_generator.state,
+                  "map": {k: np.asarray(getattr(self, k)).item() for k in CHECKPOINT_ATTRS},
+                  "obstacle_ids": [o_id if isinstance(o_id, str) else int(o_id) for o_id in self.obstacles["id"]]}
+        arrays = {"p": traj.row("p", t), "v": traj.row("v", t), "init_positions": self.init_positions_array,
+                  "agent_ids": self.agents["id"], "groups": self.agents["group"], "radii": self.agents["r"],
+                  "obstacle_bounds": self.obstacle_bounds}
+        if traj.first_row("C_O_M") is not None:
+            arrays["C_O_M"] = traj.first_row("C_O_M")
+        return pack_blob(header, arrays)
+
+    def restore(self, blob):
+        """ Continue from a checkpoint() blob in O(N). If this map still holds the same state at that step, the
+            history is only truncated after it; otherwise a new history starts at that step. Events of map.events
+            after that step are dropped """
+        if isinstance(self.trajectory, StreamingTrajectory) and self.trajectory.sink is not None:
+            raise ValueError("Cannot restore a map that is streaming to disk, the files already hold the steps after "
+                             "the checkpoint; call storage.stop_stream first")
+        header, arrays = unpack_blob(blob)
+        for k, value in header["map"].items():
+            setattr(self, k, value)
+        self.seed = header["seed"]
+        bit_generator = getattr(np.random, header["rng"]["bit_generator"])()
+        bit_generator.state = header["rng"]
+        self.rng = np.random.Generator(bit_generator)
+        self.agents.clear()
+        self.agents.extend(len(arrays["agent_ids"]), id=arrays["agent_ids"], group=arrays["groups"], r=arrays["radii"])
+        self.obstacles.clear()
+        self.obstacles.extend(len(arrays["obstacle_bounds"]), id=np.array(header["obstacle_ids"], dtype=object),
+                              bounds=arrays["obstacle_bounds"].reshape(-1, 4))
+        self.build_obstacle_index()
+        self.init_positions_array = arrays["init_positions"]
+
+        t, traj = header["step"], self.trajectory
+        if (type(traj) is Trajectory and traj.start <= t <= traj.n_steps
+                and np.array_equal(traj.row("p", t), arrays["p"]) and np.array_equal(traj.row("v", t), arrays["v"])):
+            traj.truncate(t)
+        else:
+            first = {"C_O_M": arrays["C_O_M"]} if "C_O_M" in arrays else None
+            traj = Trajectory(arrays["p"], init_velocities=arrays["v"], start=t, first=first)
+        self.attach_trajectory(traj)
+        if self.events is not None:
+            self.events.truncate(t)
+
+def pack_blob(header, arrays):
+    """ MAGIC, header length, JSON header, then the raw arrays it describes """
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+    header = dict(header, arrays={name: [a.dtype.str, list(a.shape)] for name, a in arrays.items()})
+    head = json.dumps(header, default=lambda o: o.tolist()).encode()
+    return b"".join([CHECKPOINT_MAGIC, len(head).to_bytes(4, "little"), head] + [a.tobytes() for a in arrays.values()])
+
+def unpack_blob(blob):
+    if not blob.startswith(CHECKPOINT_MAGIC):
+        raise ValueError("not a Map.checkpoint blob")
+    pos = len(CHECKPOINT_MAGIC)
+    n = int.from_bytes(blob[pos:pos+4], "little")
+    header = json.loads(blob[pos+4:pos+4+n])
+    pos += 4 + n
+    arrays = {}
+    for name, (dtype, shape) in header.pop("arrays").items():
+        a = np.frombuffer(blob, dtype=dtype, count=int(np.prod(shape)), offset=pos).reshape(shape)
+        arrays[name] = a.copy()
+        pos += a.nbytes
+    return header, arrays
@@ -0,0 +1,139 @@
+import numpy as np
+
+from spatial import CellList
+
+# Spacing and obstacle violations as compact event records. An AGENT event is a pair i < j closer than d_min_aa,
+# depth = d_min_aa - distance. An OBSTACLE event is agent i whose disc of radius r reaches into obstacle row j
+# (see map.obstacles["id"] for its id), depth = r - distance to the rectangle, plus the distance to its
+# nearest edge when the center is inside. Both use the neighbour structures of the vectorized step.
+
+EVENT_DTYPE     = np.dtype([("t", np.int64), ("kind", np.int8), ("i", np.int32), ("j", np.int32), ("depth", float)])
+STEP_DTYPE      = np.dtype([("t", np.int64), ("min_agent_dist", float)])
+AGENT, OBSTACLE = 0, 1
+EVENT_CAPACITY  = 1024
+
+def make_events(t, kind, i, j, depth):
+    events = np.empty(len(i), dtype=EVENT_DTYPE)
+    events["t"], events["kind"], events["i"], events["j"], events["depth"] = t, kind, i, j, depth
+    return events
+
+def separation_events(positions, d_min, t=0):
+    chunks = []
+    for i, j in CellList(positions, d_min).pairs(radius=d_min):
+        keep = i < j
+        i, j = i[keep], j[keep]
+        chunks.append(make_events(t, AGENT, i, j, d_min - np.linalg.norm(positions[j] - positions[i], axis=1)))
+    return np.concatenate(chunks) if chunks else np.empty(0, dtype=EVENT_DTYPE)
+
+def separation_scan(positions, d_min, t=0):
+    """ separation_events and the smallest pair distance (inf for fewer than two agents) from one pass over
+        cells of 2*d_min. Neighbouring cells hold every pair closer than the cell size, so the minimum is exact
+        once it is below it; otherwise only the minimum is searched again with doubled cells """
+    chunks, closest, cell_size = [], np.inf, 2*d_min
+    for i, j in CellList(positions, cell_size).pairs():
+        keep = i < j
+        i, j = i[keep], j[keep]
+        dists = np.linalg.norm(positions[j] - positions[i], axis=1)
+        closest = min(closest, dists.min(initial=np.inf))
+        near = dists < d_min
+        chunks.append(make_events(t, AGENT, i[near], j[near], d_min - dists[near]))
+    while closest >= cell_size:
+        cell_size *= 2
+        cells = CellList(positions, cell_size)
+        for i, j in cells.pairs():
+            closest = min(closest, np.linalg.norm(positions[j] - positions[i], axis=1).min(initial=np.inf))
+        if np.all(cells.shape <= 2):    # every pair was a neighbour pair
+            break
+    return (np.concatenate(chunks) if chunks else np.empty(0, dtype=EVENT_DTYPE)), closest
+
+def obstacle_events(positions, obstacle_index, radii, t=0):
+    r_max = float(np.max(radii, initial=0))
+    i, o = obstacle_index.query_radius(positions, r_max)
+    radii = np.broadcast_to(radii, len(positions))[i]
+    bounds = obstacle_index.bounds[o]
+    p = positions[i]
+    dist = np.linalg.norm(np.clip(p, bounds[:, :2], bounds[:, 2:]) - p, axis=1)
+    inside = np.min(np.concatenate((p - bounds[:, :2], bounds[:, 2:] - p), axis=1), axis=1)
+    depth = radii - dist + np.where(dist == 0, inside, 0)
+    keep = depth > 0
+    return make_events(t, OBSTACLE, i[keep], o[keep], depth[keep])
+
+def detect(map, positions, t=0):
+    """ Every violation of the agents at positions, recorded as step t """
+    obstacle_index = map.obstacle_index if map.obstacle_index is not None else map.build_obstacle_index()
+    return np.concatenate((separation_events(positions, map.d_min_aa, t),
+                           obstacle_events(positions, obstacle_index, map.agents["r"], t)))
+
+def detect_trajectory(map, positions=None, start=0, every=1):
+    """ Events of a whole recorded (T, N, 2) history, e.g. of a map loaded by storage.load_map """
+    positions = map.trajectory["p"] if positions is None else positions
+    chunks = [detect(map, positions[t], t) for t in range(start, len(positions), every)]
+    return np.concatenate(chunks) if chunks else np.empty(0, dtype=EVENT_DTYPE)
+
+class EventLog:
+    """ Events found while stepping and the smallest distance between two agents of every checked step, in typed
+        arrays grown by doubling. Attach it as map.events and record_step checks every new step; the check costs
+        about one more neighbour pass per step """
+    def __init__(self, capacity=EVENT_CAPACITY):
+        self.buf = np.empty(capacity, dtype=EVENT_DTYPE)
+        self.n = 0
+        self.step_buf = np.empty(capacity, dtype=STEP_DTYPE)
+        self.n_steps = 0
+
+    @property
+    def events(self):
+        return self.buf[:self.n]
+
+    @property
+    def steps(self):
+        return self.step_buf[:self.n_steps]
+
+    @property
+    def min_agent_dist(self):
+        return float(self.steps["min_agent_dist"].min(initial=np.inf))
+
+    def append(self, events):
+        self.buf = grow(self.buf, self.n, self.n + len(events))
+        self.buf[self.n:self.n+len(events)] = events
+        self.n += len(events)
+
+    def check(self, map, positions, t):
+        obstacle_index = map.obstacle_index if map.obstacle_index is not None else map.build_obstacle_index()
+        separation, closest = separation_scan(positions, map.d_min_aa, t)
+        self.append(np.concatenate((separation, obstacle_events(positions, obstacle_index, map.agents["r"], t))))
+        self.step_buf = grow(self.step_buf, self.n_steps, self.n_steps + 1)
+        self.step_buf[self.n_steps] = (t, closest)
+        self.n_steps += 1
+
+    def truncate(self, t):
+        """ Forget every step after t, e.g. when Map.restore rewinds the map """
+        events, steps = self.events[self.events["t"] <= t], self.steps[self.steps["t"] <= t]
+        self.n, self.n_steps = len(events), len(steps)
+        self.buf[:self.n], self.step_buf[:self.n_steps] = events, steps
+
+    def summary(self, n_agents=None):
+        return {"min_agent_dist": self.min_agent_dist, **summarize(self.events, self.n_steps, n_agents)}
+
+def grow(buf, n, size):
+    """ buf, or a copy of its first n rows in a buffer twice as large if size rows do not fit """
+    if size <= len(buf):
+        return buf
+    new_buf = np.empty(max(size, 2*len(buf)), dtype=buf.dtype)
+    new_buf[:n] = buf[:n]
+    return new_buf
+
+def summarize(events, n_steps, n_agents=None):
+    """ Metrics to rank runs by: event counts and maximum depths per kind, share of checked steps with any
+        violation, first violating step (-1 if none) and the number of distinct agents involved """
+    agent, obstacle = events["kind"] == AGENT, events["kind"] == OBSTACLE
+    involved = np.unique(np.concatenate((events["i"], events["j"][agent])))
+    metrics = {"separation_violations": int(agent.sum()),
+               "obstacle_collisions": int(obstacle.sum()),
+               "max_separation_depth": float(np.max(events["depth"][agent], initial=0)),
+               "max_collision_depth": float(np.max(events["depth"][obstacle], initial=0)),
+               "violation_step_rate": len(np.unique(events["t"])) / n_steps if n_steps else 0.0,
+               "first_violation": int(events["t"].min()) if len(events) else -1,
+               "agents_involved": len(involved)}
+    if n_agents:
+        metrics["agents_involved_rate"] = len(involved) / n_agents
+    return metrics
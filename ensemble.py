@@ -0,0 +1,130 @@
+import numpy as np
+
+from classes import Map, Trajectory
+from initialize_map import init_map
+from target_points import TARGET_BLOCK
+from velocity_control import (compute_v_rep_all, compute_v_att_all, compute_v_obst_all, compute_v_target, clip_norm,
+                              numba_kernels, BACKEND, V_MAX, R_REP, R_ATT, K_REP, K_ATT, K_TARGET)
+
+FIELDS = ("C_O_M", "p", "p_target", "v", "v_target", "v_field", "v_des")
+
+class Ensemble:
+    """ B independent maps with the same number of agents, stepped together on stacked (B, N, 2) arrays so the
+        Python overhead of a step is paid once for the whole ensemble. Obstacle bounds are padded to the largest
+        obstacle count and masked. The field is the dense one, so the NumPy backend needs B*N^2 memory """
+    def __init__(self, maps):
+        maps = list(maps)
+        if len({len(m.agents) for m in maps}) > 1:
+            raise ValueError("all maps of an ensemble need the same number of agents")
+        if len({m.trajectory.n_steps for m in maps}) > 1:
+            raise ValueError("all maps of an ensemble need the same number of recorded steps")
+        if len({m.trajectory.start for m in maps}) > 1:
+            raise ValueError("all maps of an ensemble need histories starting at the same step")
+        self.maps = maps
+        self.dt = np.array([m.dt for m in maps])
+        n_obst = max((len(m.obstacles) for m in maps), default=0)
+        self.obstacle_bounds = np.zeros((len(maps), n_obst, 4))
+        self.obstacle_valid = np.zeros((len(maps), n_obst), dtype=bool)
+        for b, m in enumerate(maps):
+            self.obstacle_bounds[b, :len(m.obstacles)] = m.obstacle_bounds
+            self.obstacle_valid[b, :len(m.obstacles)] = True
+
+        # Groups become rows of a (B*G) table so one bincount gives every center of mass
+        indices = [m.group_index() for m in maps]
+        self.n_groups = [len(groups) for groups, _, _ in indices]
+        n_groups = max(self.n_groups, default=0)
+        self.group_idx = np.array([group_idx for _, group_idx, _ in indices]).reshape(len(maps), -1)
+        self.flat_group = (self.group_idx + n_groups*np.arange(len(maps))[:, None]).ravel()
+        self.counts = np.zeros((len(maps), n_groups))
+        for b, (_, _, counts) in enumerate(indices):
+            self.counts[b, :len(counts)] = counts
+
+        arrays = {}
+        for name in FIELDS:
+            if name in maps[0].trajectory.data:
+                arrays[name] = np.stack([pad_groups(m.trajectory[name], n_groups) if name == "C_O_M" else
+                                         m.trajectory[name] for m in maps], axis=1)
+        first = {}
+        if any("C_O_M" in m.trajectory.first for m in maps):    # target origins of histories restarted by Map.restore
+            first["C_O_M"] = np.stack([pad_groups(m.trajectory.first_row("C_O_M")[None], n_groups)[0] for m in maps])
+        self.trajectory = Trajectory.from_arrays(arrays, start=maps[0].trajectory.start, first=first)
+        self.target_table, self.target_start = None, 0
+
+    @classmethod
+    def generate(cls, n_maps, seed=0, **map_kwargs):
+        """ n_maps maps built by init_map from Map(**map_kwargs), each with its own seed derived from seed """
+        seeds = np.random.SeedSequence(seed).generate_state(n_maps, dtype=np.uint64)
+        maps = []
+        for s in seeds:
+            map = Map(seed=int(s), **map_kwargs)
+            init_map(map)
+            maps.append(map)
+        return cls(maps)
+
+    @property
+    def n_steps(self):
+        return self.trajectory.n_steps
+
+    def compute_com(self, positions):
+        n_maps, n_groups = self.counts.shape
+        sums = np.stack([np.bincount(self.flat_group, weights=positions[..., k].ravel(), minlength=n_maps*n_groups)
+                         for k in range(2)], axis=-1).reshape(n_maps, n_groups, 2)
+        return np.divide(sums, self.counts[..., None], out=np.full_like(sums, np.nan), where=self.counts[..., None] > 0)
+
+    def targets(self, t_idx, origins):
+        """ (B, G, 2) targets of step t_idx from the Targets of every map, evaluated TARGET_BLOCK steps at a time """
+        k = t_idx - self.target_start
+        if self.target_table is None or not 0 <= k < len(self.target_table):
+            self.target_table = np.full((TARGET_BLOCK,) + origins.shape, np.nan)
+            for b, m in enumerate(self.maps):
+                groups, n = m.group_index()[0], self.n_groups[b]
+                times = (t_idx + np.arange(TARGET_BLOCK)) * m.dt
+                self.target_table[:, b, :n] = m.targets.evaluate(times, groups, origins[b, :n])
+            self.target_start, k = t_idx, 0
+        return self.target_table[k]
+
+    def step(self, n_steps=1, v_max=V_MAX, r_rep=R_REP, r_att=R_ATT, k_rep=K_REP, k_att=K_ATT, k_target=K_TARGET,
+             backend=None):
+        """ Same update as velocity_control.append_vel_pos on the dense vectorized path, for every map at once """
+        backend = backend or BACKEND
+        if backend == "numba" and numba_kernels is None:
+            raise ValueError("backend='numba' needs numba installed")
+        traj = self.trajectory
+        for _ in range(n_steps):
+            t_idx = traj.n_steps
+            positions, velocities = traj.row("p", t_idx), traj.row("v", t_idx)
+            center_of_mass = self.compute_com(positions)
+            first_com = traj.first_row("C_O_M", center_of_mass)
+            target = self.targets(t_idx, first_com)
+            if backend == "numba":
+                v_fields = numba_kernels.ensemble_field_kernel(np.ascontiguousarray(positions), self.obstacle_bounds,
+                                                               self.obstacle_valid, r_rep, k_rep, r_att, k_att)
+            else:
+                diffs = positions[:, None, :, :] - positions[:, :, None, :]     # (B, N, N, 2)
+                dists = np.linalg.norm(diffs, axis=-1)
+                v_fields = (compute_v_rep_all(diffs, dists, r_rep, k_rep) + compute_v_att_all(diffs, dists, r_att, k_att)
+                            + compute_v_obst_all(positions, self.obstacle_bounds, r_rep, k_rep, self.obstacle_valid))
+            p_targets = np.take_along_axis(target, self.group_idx[..., None], axis=1)
+            com = np.take_along_axis(center_of_mass, self.group_idx[..., None], axis=1)
+            v_targets = compute_v_target(k_target, p_targets, com)
+            v_dess = clip_norm(v_fields + v_targets, v_max)
+            p = positions + velocities * self.dt[:, None, None]
+            for name, values in zip(FIELDS, (center_of_mass, p, p_targets, v_dess, v_targets, v_fields, v_dess)):
+                traj.append(name, values)
+
+    def to_maps(self):
+        """ Copy the ensemble history back into the maps it was built from and return them """
+        traj = self.trajectory
+        for b, map in enumerate(self.maps):
+            n_groups = self.n_groups[b]
+            arrays = {name: traj[name][:, b].copy() for name in traj.data}
+            if "C_O_M" in arrays:
+                arrays["C_O_M"] = arrays["C_O_M"][:, :n_groups]
+            first = {name: row[b, :n_groups].copy() for name, row in traj.first.items()}
+            map.attach_trajectory(Trajectory.from_arrays(arrays, start=traj.start, first=first))
+        return self.maps
+
+def pad_groups(center_of_mass, n_groups):
+    padded = np.full((len(center_of_mass), n_groups, 2), np.nan)
+    padded[:, :center_of_mass.shape[1]] = center_of_mass
+    return padded
@@ -0,0 +1,189 @@
+import os
+import shutil
+import subprocess
+from collections import deque
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import GifImagePlugin, Image
+
+from pools import process_pool
+from renderer import MapRenderer
+from storage import load_map
+
+FPS             = 30
+FIGSIZE         = (6, 6)
+DPI             = 100
+FRAMES_PER_JOB  = 64
+GIF_COLORS      = 63        # palette size of GIF exports, index GIF_COLORS marks pixels left unchanged
+CODECS          = {".mp4": ["-c:v", "libx264", "-pix_fmt", "yuv420p", "-crf", "23"],
+                   ".webm": ["-c:v", "libvpx-vp9", "-pix_fmt", "yuv420p", "-b:v", "0", "-crf", "35"]}
+
+def find_ffmpeg():
+    path = shutil.which("ffmpeg")
+    if path is None:
+        try:
+            import imageio_ffmpeg
+            path = imageio_ffmpeg.get_ffmpeg_exe()
+        except ImportError:
+            pass
+    return path
+
+def render_job(job):
+    """ Rasterise a block of frames off-screen with Agg, returning an (n, H, W, 3) uint8 array.
+        Obstacles and axes are drawn once, each frame only restores that background and draws the collections """
+    static, positions, center_of_mass = job
+    fig = Figure(figsize=static["figsize"], dpi=static["dpi"])
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    renderer = MapRenderer(ax, static["obstacle_bounds"], static["radii"], positions[0], center_of_mass[0])
+    x_min, y_min, x_max, y_max = static["rectangle"]
+    ax.set_xlim(x_min, x_max)
+    ax.set_ylim(y_min, y_max)
+    ax.set_xlabel("X coordinate")
+    ax.set_ylabel("Y coordinate")
+    ax.set_title("Agent Map with Obstacles and Swarm Centers")
+    ax.set_aspect('equal', adjustable='box')
+    ax.grid(True)
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+    frames = []
+    for p, c in zip(positions, center_of_mass):
+        canvas.restore_region(background)
+        renderer.update(p, c)
+        renderer.draw_artists()
+        frames.append(np.asarray(canvas.buffer_rgba())[..., :3].copy())
+    return np.array(frames)
+
+def frame_jobs(map, frames, static, frames_per_job):
+    positions, center_of_mass = map.trajectory["p"], map.C_O_M
+    for lo in range(0, len(frames), frames_per_job):
+        idx = frames[lo:lo+frames_per_job]
+        yield static, positions[idx], center_of_mass[idx]
+
+def ordered_map(pool, fn, jobs, max_pending):
+    """ Like pool.map but submits at most max_pending jobs ahead of the consumer, so frames sliced
+        from a memory-mapped run are only copied shortly before they are encoded """
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.submit(fn, job))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def next_filename(folder, ext, base_name="my_animation"):
+    os.makedirs(folder, exist_ok=True)
+    i = 0
+    filename = os.path.join(folder, f"{base_name}{i}{ext}")
+    while os.path.exists(filename):
+        i += 1
+        filename = os.path.join(folder, f"{base_name}{i}{ext}")
+    return filename
+
+def export_animation(map, filename=None, folder="my_animations", ext=".mp4", fps=FPS, frame_step=None,
+                     frame_min=0, frame_max=-1, rectangle=None, workers=None, frames_per_job=FRAMES_PER_JOB):
+    """ Render frames on a process pool and encode them in order, to MP4/WebM through ffmpeg or to a
+        palette GIF through Pillow (also the fallback when ffmpeg is missing). With frame_step=None every
+        frame_step-th step is kept so that playback at fps runs in real time; there is no frame cap.
+        The pool workers import the calling script, so call it under `if __name__ == "__main__":` """
+    if isinstance(map, (str, os.PathLike)):
+        map = load_map(map)
+    if filename is not None:
+        ext = os.path.splitext(filename)[1]
+    ffmpeg = find_ffmpeg() if ext in CODECS else None
+    if ext in CODECS and ffmpeg is None:
+        print("ffmpeg unavailable, writing a GIF instead")
+        ext = ".gif"
+        filename = os.path.splitext(filename)[0] + ext if filename is not None else None
+    filename = filename or next_filename(folder, ext)
+    if frame_step is None:
+        frame_step = max(1, round(1 / (fps * map.dt)))
+    n_com = len(map.C_O_M)
+    frames = np.arange(frame_min, n_com if frame_max == -1 else frame_max, frame_step)
+    if rectangle is None:
+        rectangle = (map.x_min, map.y_min, map.x_max, map.y_max)
+    static = {"obstacle_bounds": np.array(map.obstacle_bounds), "radii": map.agents["r"],
+              "rectangle": rectangle, "figsize": FIGSIZE, "dpi": DPI}
+
+    with process_pool(workers) as pool:
+        blocks = ordered_map(pool, render_job, frame_jobs(map, frames, static, frames_per_job),
+                             2*(workers or os.cpu_count() or 1))
+        if ext == ".gif":
+            write_gif(blocks, filename, fps)
+        else:
+            write_video(blocks, filename, fps, ffmpeg, CODECS[ext])
+    print(f"Animation saved as {filename} ({len(frames)} frames)")
+    return filename
+
+def write_video(blocks, filename, fps, ffmpeg, codec):
+    process = None
+    for block in blocks:
+        if process is None:
+            h, w = block.shape[1:3]
+            w_even, h_even = w - w % 2, h - h % 2     # yuv420p needs even dimensions
+            cmd = [ffmpeg, "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "rgb24",
+                   "-s", f"{w}x{h}", "-r", str(fps), "-i", "-", "-vf", f"crop={w_even}:{h_even}:0:0",
+                   *codec, filename]
+            process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        process.stdin.write(np.ascontiguousarray(block).tobytes())
+    if process is not None:
+        process.stdin.close()
+        if process.wait():
+            raise RuntimeError(f"ffmpeg failed with exit code {process.returncode}")
+
+def write_gif(blocks, filename, fps):
+    """ All frames share the adaptive palette of the first one and are written as they arrive, each cropped to
+        the box that changed since the previous frame, with the unchanged pixels inside it transparent
+        (disposal 1 leaves the previous frame on screen), so memory stays at one frame for any length.
+        A frame equal to the previous one only extends its duration """
+    duration = round(1000/fps)
+    fp, palette, previous, pending = None, None, None, None
+    try:
+        for block in blocks:
+            for frame in block:
+                image = Image.fromarray(frame)
+                if palette is None:
+                    palette = image.quantize(colors=GIF_COLORS, method=Image.Quantize.MEDIANCUT)
+                    fp = open(filename, "wb")
+                    header, _ = GifImagePlugin.getheader(palette.copy(), info={"loop": 0, "duration": duration})
+                    fp.write(b"".join(header))
+                image = image.quantize(palette=palette, dither=Image.Dither.NONE)
+                index = np.asarray(image)
+                box = changed_box(previous, index)
+                if box is None:
+                    pending[2] += duration
+                    continue
+                if pending is not None:
+                    write_gif_frame(fp, *pending)
+                pending, previous = [delta_image(previous, index, box, palette), box[:2], duration], index
+        if pending is not None:
+            write_gif_frame(fp, *pending)
+            fp.write(b";")
+    finally:
+        if fp is not None:
+            fp.close()
+
+def write_gif_frame(fp, image, offset, duration):
+    fp.write(b"".join(GifImagePlugin.getdata(image, offset, duration=duration, disposal=1, transparency=GIF_COLORS)))
+
+def delta_image(previous, index, box, palette):
+    left, upper, right, lower = box
+    crop = index[upper:lower, left:right]
+    if previous is not None:
+        crop = np.where(previous[upper:lower, left:right] == crop, GIF_COLORS, crop).astype(np.uint8)
+    image = Image.fromarray(np.ascontiguousarray(crop), mode="P")
+    image.putpalette(palette.getpalette())
+    return image
+
+def changed_box(previous, index):
+    """ (left, upper, right, lower) box of the pixels of index that differ from previous, the whole frame
+        without a previous one, None if nothing changed """
+    if previous is None:
+        return (0, 0, index.shape[1], index.shape[0])
+    changed = previous != index
+    rows, cols = np.flatnonzero(changed.any(axis=1)), np.flatnonzero(changed.any(axis=0))
+    if not len(rows):
+        return None
+    return (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
@@ -1,121 +1,278 @@
 import numpy as np
 
-from classes import Agent, Obstacle
+from classes import (DRONE_SIZE, D_MIN_SCALE, MAX_AGENT_OCCUPATION_RATE, MAX_OBSTACLE_NON_ACC_RATE,
+                     MAX_OBSTACLE_OCCUPATION_RATE)
+from spatial import CellList, PoissonGrid
+from velocity_control import get_obstacle_field, R_REP
 
-def init_map(map):
+POISSON_K       = 30        # candidates per active point in Bridson's algorithm
+BATCH_SIZE      = 4096      # candidates per NumPy call in batched dart throwing
+MAX_FAILED      = 20        # consecutive empty batches before giving up
+CANDIDATE_BLOCK = 256       # candidates drawn per generator call in the one-at-a-time samplers
+MAX_OBSTACLE_TRIES = MAX_FAILED * CANDIDATE_BLOCK   # rejected candidates in a row before a placement gives up
+OBSTACLE_ATTEMPTS = 5       # placements generate_obstacles tries before lowering n_obstacles
+
+D_MIN_AA        = D_MIN_SCALE * DRONE_SIZE          # same distances as Map.d_min_aa, Map.d_min_ao and Map.d_min_oo
+D_MIN_AO        = D_MIN_AA - DRONE_SIZE/2
+D_MIN_OO        = D_MIN_AA
+AGENT_AREA      = np.pi * (D_MIN_AA/2)**2           # area one agent takes up in Map.p_ag_rate
+
+def init_map(map, seed=None):
+    if seed is not None:
+        map.seed_rng(seed)
+    print("Map seed:", map.seed)
     modify_map(map, a=False)
     modify_map(map, a=True)
     generate_obstacles(map)
     generate_agents(map)
+    get_obstacle_field(map, R_REP)
 
 def modify_map(map, a):
-    p_rate = map.p_ag_rate if a else map.p_ob_rate
+    """ Make the agents (a=True) or the obstacles fit: shrink their count on a fixed size map, otherwise grow
+        the map by the smallest scale, rounded up to 0.01, that brings the occupation rate back to 1 """
     name = "agents" if a else "obstacles"
-    if p_rate > 1:
-        if map.fixed_map_size:
-            old_n = map.n_agents if a else map.n_obstacles_walls_excluded
-            new_n = int(old_n/p_rate)
-            if a:
-                map.n_agents = new_n
-            else:
-                map.n_obstacles_walls_excluded = new_n
+    lens = (map.len_x, map.len_y, map.len_x_obst, map.len_y_obst)
+    if map.fixed_map_size:
+        n_agents, n_obstacles = feasible_counts(map.n_agents, map.n_obstacles_walls_excluded, *lens, map.map_walls)
+        if a:
+            map.n_agents = int(n_agents)
         else:
-            if a:
-                a_pol = map.a_map - map.a_obsts
-                b_pol = (map.len_x + map.len_y) * map.d_signed - 2 * map.d_min_ao * np.sqrt(map.a_obsts * map.n_obstacles_walls_excluded)
-                c_pol = (1 - p_rate) * map.d_min_ao**2 * map.n_obstacles_walls_excluded - p_rate * (a_pol + b_pol)
-            else:
-                c_pol = p_rate * map.d_min_ao**2  * map.n_obstacles_walls_excluded
-                b_pol = p_rate * 2 * map.d_min_ao * np.sqrt(map.a_obsts * map.n_obstacles_walls_excluded)
-                a_pol = (p_rate - 1) * map.a_obsts - (1/p_rate) * (b_pol + c_pol)
-            roots = np.roots([a_pol,b_pol,c_pol])
-            real_roots = roots[np.real(roots)==roots]
-            usable_roots = real_roots[real_roots>0]
-            new_scale = min(usable_roots) if usable_roots.size else None
-            if new_scale is not None:
-                new_scale_rounded = (100*new_scale//1+1)/100
-                rescale_map(map, new_scale_rounded)
-                print(f"Too many {name}, rescaling map using n =",new_scale_rounded)
-            else:
-                while(p_rate > 1):
-                    p_rate_rounded = (100*p_rate//1+1)/100
-                    rescale_map(map, p_rate_rounded)
-                    print(f"Too many {name}, rescaling map using p =", p_rate_rounded)
-                    p_rate = map.p_ag_rate if a else map.p_ob_rate
+            map.n_obstacles_walls_excluded = int(n_obstacles)
+    else:
+        if a:
+            scale = agent_scale(map.n_agents, map.n_obstacles_walls_excluded, *lens, map.map_walls)
+        else:
+            scale = obstacle_scale(map.n_obstacles_walls_excluded, *lens, map.map_walls)
+        if scale > 1:
+            new_scale = np.ceil(100*scale)/100
+            rescale_map(map, new_scale)
+            print(f"Too many {name}, rescaling map using n =", new_scale)
+
+# Occupation constraints of Map.p_ob_rate and Map.p_ag_rate as quadratics in the scale s applied to the map and
+# obstacle sizes. Both rates only decrease for s past the largest root, so that root is the smallest feasible
+# scale. Every function broadcasts over array arguments, for planning many configurations at once.
 
-def rescale_map(map,new_scale):
+def largest_root(qa, qb, qc):
+    """ Largest real root of qa*s^2 + qb*s + qc with qa > 0, 0 when there is none, inf where qa <= 0 """
+    qa, qb, qc = np.broadcast_arrays(*map(np.asarray, (qa, qb, qc)))
+    disc = qb**2 - 4*qa*qc
+    with np.errstate(divide="ignore", invalid="ignore"):
+        root = np.where(disc >= 0, (-qb + np.sqrt(np.maximum(disc, 0))) / (2*qa), 0.0)
+    return np.where(qa > 0, np.maximum(root, 0.0), np.inf)
+
+def obstacle_scale(n_obstacles, len_x, len_y, len_x_obst, len_y_obst, map_walls=False):
+    """ Smallest s with p_ob_rate <= 1, i.e. n*(lxo*s + d)*(lyo*s + d) <= rate*(lx*s + e)*(ly*s + e) with
+        rate = MAX_OBSTACLE_NON_ACC_RATE, d = D_MIN_OO and e = -d with walls, +d without """
+    n, d, rate = np.asarray(n_obstacles), D_MIN_OO, MAX_OBSTACLE_NON_ACC_RATE
+    e = -D_MIN_OO if map_walls else D_MIN_OO
+    qa = rate*len_x*len_y - n*len_x_obst*len_y_obst
+    qb = rate*e*(len_x + len_y) - n*d*(len_x_obst + len_y_obst)
+    root = largest_root(qa, qb, rate*e**2 - n*d**2)
+    return np.where(n > 0, root, 0.0)
+
+def agent_scale(n_agents, n_obstacles, len_x, len_y, len_x_obst, len_y_obst, map_walls=False):
+    """ Smallest s with p_ag_rate <= 1, i.e. a_free(s) >= a_agents/MAX_AGENT_OCCUPATION_RATE """
+    n, d = np.asarray(n_obstacles), D_MIN_AO
+    d_signed = -D_MIN_AA if map_walls else D_MIN_AA
+    a_needed = AGENT_AREA*np.asarray(n_agents) / MAX_AGENT_OCCUPATION_RATE
+    qa = len_x*len_y - n*len_x_obst*len_y_obst
+    qb = d_signed*(len_x + len_y) - n*d*(len_x_obst + len_y_obst)
+    root = largest_root(qa, qb, d_signed**2 - n*d**2 - a_needed)
+    return np.where(a_needed > 0, root, 0.0)
+
+def feasible_counts(n_agents, n_obstacles, len_x, len_y, len_x_obst, len_y_obst, map_walls=False):
+    """ Largest counts up to the requested ones that fit without rescaling, obstacles first """
+    d = D_MIN_AO
+    d_signed = -D_MIN_AA if map_walls else D_MIN_AA
+    a_obst = (len_x_obst + d)*(len_y_obst + d)
+    a_packed = (len_x_obst + D_MIN_OO)*(len_y_obst + D_MIN_OO)
+    max_obst = np.floor(MAX_OBSTACLE_NON_ACC_RATE*np.maximum((len_x + d_signed)*(len_y + d_signed), 0) / a_packed)
+    n_obstacles = np.minimum(n_obstacles, max_obst).astype(int)
+    a_free = (len_x + d_signed)*(len_y + d_signed) - n_obstacles*a_obst
+    max_agents = np.floor(MAX_AGENT_OCCUPATION_RATE*np.maximum(a_free, 0) / AGENT_AREA)
+    return np.minimum(n_agents, max_agents).astype(int), n_obstacles
+
+def plan_map(n_agents, n_obstacles, len_x, len_y, map_walls=False, fixed_map_size=False):
+    """ What modify_map would do to Map(n_agents, n_obstacles, len_x, len_y, ...), without building it and without
+        printing: (scale, n_agents, n_obstacles) with the smallest unrounded scale >= 1, or with fixed_map_size a
+        scale of 1 and the largest counts that fit """
+    n_agents, n_obstacles = np.asarray(n_agents), np.asarray(n_obstacles)
+    len_x, len_y = np.maximum(len_x, DRONE_SIZE), np.maximum(len_y, DRONE_SIZE)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        len_obst = np.where(n_obstacles > 0, np.sqrt(MAX_OBSTACLE_OCCUPATION_RATE*len_x*len_y / n_obstacles), 0.0)
+    if fixed_map_size:
+        n_agents, n_obstacles = feasible_counts(n_agents, n_obstacles, len_x, len_y, len_obst, len_obst, map_walls)
+        return np.ones(np.shape(n_agents)), n_agents, n_obstacles
+    scale = np.maximum.reduce([np.ones(np.shape(len_obst)),
+                               obstacle_scale(n_obstacles, len_x, len_y, len_obst, len_obst, map_walls),
+                               agent_scale(n_agents, n_obstacles, len_x, len_y, len_obst, len_obst, map_walls)])
+    return scale, np.broadcast_to(n_agents, scale.shape), np.broadcast_to(n_obstacles, scale.shape)
+
+def rescale_map(map, new_scale):
+    """ Scale the map, the obstacle size and every placed obstacle about (x_min, y_min). Walls span the map
+        edges, so scaling them the same way keeps them on the new edges """
     map.len_x, map.len_y = map.len_x*new_scale, map.len_y*new_scale
     map.x_max = map.x_min + map.len_x
     map.y_max = map.y_min + map.len_y
-    
     map.len_x_obst, map.len_y_obst = map.len_x_obst*new_scale, map.len_y_obst*new_scale
-    if np.any(map.all_obstacles):
-        for obst in map.all_obstacles:
-            if obst.id == "left_wall":
-                obst.y_max = map.y_max
-            elif obst.id == "right_wall":
-                obst.x_min,obst.x_max,obst.y_max = map.x_max,map.x_max,map.y_max
-            elif obst.id == "down_wall":
-                obst.x_max = map.x_max
-            elif obst.id == "up_wall":
-                obst.x_max,obst.y_min,obst.y_max = map.x_max,map.y_max,map.y_max
-            else:
-                obst.x_min, obst.y_min = obst.x_min*new_scale, obst.y_min*new_scale
-                obst.x_max, obst.y_max = obst.x_max*new_scale, obst.y_max*new_scale
+    if len(map.obstacles):
+        origin = np.array([map.x_min, map.y_min, map.x_min, map.y_min])
+        map.obstacles.set("bounds", slice(None), origin + (map.obstacle_bounds - origin)*new_scale)
+        map.build_obstacle_index()
 
 def generate_obstacles(map):
+    """ Place the obstacles by rejection sampling. A placement that jams before all of them fit is started
+        over, up to OBSTACLE_ATTEMPTS times, and the fullest one is kept with n_obstacles lowered to match """
     if map.map_walls:
-        left_wall = Obstacle(id="left_wall",x_min=map.x_min,y_min=map.y_min,
-                                x_max=map.x_min,y_max=map.y_max)
-        right_wall = Obstacle(id="right_wall",x_min=map.x_max,y_min=map.y_min,
-                                x_max=map.x_max,y_max=map.y_max)
-        down_wall = Obstacle(id="down_wall",x_min=map.x_min,y_min=map.y_min,
-                                x_max=map.x_max,y_max=map.y_min)
-        up_wall = Obstacle(id="up_wall",x_min=map.x_min,y_min=map.y_max,
-                            x_max=map.x_max,y_max=map.y_max)
-        map.all_obstacles = np.append(map.all_obstacles,[left_wall,right_wall,down_wall,up_wall])
+        map.add_obstacle("left_wall", [map.x_min, map.y_min, map.x_min, map.y_max])
+        map.add_obstacle("right_wall", [map.x_max, map.y_min, map.x_max, map.y_max])
+        map.add_obstacle("down_wall", [map.x_min, map.y_min, map.x_max, map.y_min])
+        map.add_obstacle("up_wall", [map.x_min, map.y_max, map.x_max, map.y_max])
+    candidates = candidate_stream(map.rng, [map.x_min, map.y_min],
+                                  [map.x_max-map.len_x_obst, map.y_max-map.len_y_obst])
+    best, best_stats = [], (0, 0, 0)
+    for _ in range(OBSTACLE_ATTEMPTS):
+        rects, stats = place_obstacles(map, candidates)
+        if len(rects) > len(best) or not best:
+            best, best_stats = rects, stats
+        if len(best) == map.n_obstacles_walls_excluded:
+            break
+    print(*best_stats)
+    if len(best) < map.n_obstacles_walls_excluded:
+        print(f"Only room for {len(best)} obstacles, reducing n_obstacles from {map.n_obstacles_walls_excluded}")
+        map.n_obstacles -= map.n_obstacles_walls_excluded - len(best)
+        map.n_obstacles_walls_excluded = len(best)
+    map.obstacles.reserve(len(map.obstacles) + len(best))
+    map.obstacle_index = None
+    for i, rect in enumerate(best):
+        map.add_obstacle(i, rect)
+    map.build_obstacle_index()
+
+def place_obstacles(map, candidates):
+    """ One attempt: obstacles placed next to the walls until all fit or one is rejected MAX_OBSTACLE_TRIES
+        times in a row, with the (iterations, j_max, idx_j_max) rejection statistics """
+    index = map.build_obstacle_index()
+    rects = []
     iter,j_max,idx_j_max = 0,0,0
     for i in range(map.n_obstacles_walls_excluded):
         j=0
-        while True:
-            x_min = np.random.uniform(map.x_min, map.x_max-map.len_x_obst)
-            y_min = np.random.uniform(map.y_min, map.y_max-map.len_y_obst)
+        while j < MAX_OBSTACLE_TRIES:
+            x_min, y_min = next(candidates)
             x_max, y_max = x_min+map.len_x_obst, y_min+map.len_y_obst
-            obst = Obstacle(id=i,x_min=x_min,y_min=y_min,x_max=x_max,y_max=y_max)
-            if not np.any(map.all_obstacles):
-                map.all_obstacles = np.append(map.all_obstacles,obst)
+            if not index.n:
+                index.insert([x_min,y_min,x_max,y_max])
+                rects.append([x_min,y_min,x_max,y_max])
                 break
-            rectangles = [create_bigger_rectangle(o,map.d_min_oo/2) for o in map.all_obstacles]
-            rect_i = create_bigger_rectangle(obst,map.d_min_oo/2)
-            overlap = False
-            for rect in rectangles:
-                if rectangles_overlap(rect,rect_i):
-                    overlap = True
-                    break
-            if overlap:
+            # Growing only the candidate by d_min_oo is the same test as growing both by d_min_oo/2
+            d = map.d_min_oo
+            if index.overlaps([x_min-d,y_min-d,x_max+d,y_max+d]):
                 j += 1
                 continue
             iter += j+1
             if j_max < j+1:
                 j_max = j+1
                 idx_j_max = i
-            map.all_obstacles = np.append(map.all_obstacles,obst)
+            index.insert([x_min,y_min,x_max,y_max])
+            rects.append([x_min,y_min,x_max,y_max])
             break
-    print(iter,j_max,idx_j_max)
+        else:
+            break
+    return rects, (iter,j_max,idx_j_max)
+
+def generate_agents(map, method="bridson"):
+    if method == "uniform":
+        return generate_agents_uniform(map)
+    if method == "bridson":
+        points = poisson_disk_points(map, map.n_agents)
+        points = points[map.rng.permutation(len(points))[:map.n_agents]]
+    elif method == "batch":
+        points = dart_throwing_points(map, map.n_agents)
+    else:
+        raise ValueError(f"Unknown agent placement method {method!r}")
+    if len(points) < map.n_agents:
+        print(f"Only room for {len(points)} agents, reducing n_agents from {map.n_agents}")
+        map.n_agents = len(points)
+    map.agents.clear()
+    map.agents.extend(len(points), id=np.arange(len(points)), group=0, r=DRONE_SIZE/2)
+    map.init_positions_array = points
+    map.init_trajectory()
+
+def clear_of_obstacles(map, candidates):
+    if map.obstacle_index is None:
+        map.build_obstacle_index()
+    agent, _ = map.obstacle_index.query_radius(candidates, map.d_min_ao)
+    return np.bincount(agent, minlength=len(candidates)) == 0
 
-def generate_agents(map):
+def inside_map(map, candidates):
+    return ((candidates[:, 0] >= map.x_min) & (candidates[:, 0] <= map.x_max) &
+            (candidates[:, 1] >= map.y_min) & (candidates[:, 1] <= map.y_max))
+
+def poisson_disk_points(map, n=None, k=POISSON_K):
+    """ Bridson's algorithm over the free area, advancing every active point per NumPy call and reseeding with
+        uniform darts when the active list runs out. With n, it stops at n points and seeds from n uniform
+        darts, so a sparse map is covered by the darts alone and its cost follows n instead of the map area """
+    grid = PoissonGrid(map.x_min, map.y_min, map.x_max, map.y_max, map.d_min_aa)
+    active, failed = np.empty(0, dtype=np.int64), 0
+    while failed < MAX_FAILED and (n is None or grid.n < n):
+        if not len(active):
+            n_darts = k if n is None else max(k, n - grid.n)
+            candidates = map.rng.uniform([map.x_min, map.y_min], [map.x_max, map.y_max], size=(n_darts, 2))
+            parents = np.full(n_darts, -1)
+        else:
+            radius = map.rng.uniform(map.d_min_aa, 2*map.d_min_aa, (len(active), k))
+            angle = map.rng.uniform(0, 2*np.pi, (len(active), k))
+            offsets = np.stack((radius*np.cos(angle), radius*np.sin(angle)), axis=-1)
+            candidates = (grid.points[active][:, None, :] + offsets).reshape(-1, 2)
+            parents = np.repeat(active, k)
+        ok = inside_map(map, candidates)
+        ok[ok] = grid.far_enough(candidates[ok])
+        ok[ok] = clear_of_obstacles(map, candidates[ok])
+        candidates, parents = candidates[ok], parents[ok]
+        active = np.intersect1d(active, parents)    # points with no valid candidate are retired
+        candidates = resolve_conflicts(candidates, map.d_min_aa)
+        if n is not None and len(candidates) > n - grid.n:
+            candidates = candidates[map.rng.permutation(len(candidates))[:n - grid.n]]
+        grid.insert(candidates)
+        active = np.concatenate((active, np.arange(grid.n - len(candidates), grid.n)))
+        failed = 0 if len(candidates) else failed + 1
+    return grid.points.copy()
+
+def resolve_conflicts(candidates, d_min):
+    """ Within a batch, a candidate loses to any earlier one closer than d_min """
+    if len(candidates) < 2:
+        return candidates
+    conflict = np.zeros(len(candidates), dtype=bool)
+    for i, j in CellList(candidates, d_min).pairs(radius=d_min):
+        conflict[i[j < i]] = True
+    return candidates[~conflict]
+
+def dart_throwing_points(map, n, batch_size=BATCH_SIZE):
+    """ Uniform random sequential placement, testing a whole batch of candidates per NumPy call """
+    grid = PoissonGrid(map.x_min, map.y_min, map.x_max, map.y_max, map.d_min_aa)
+    failed = 0
+    while grid.n < n and failed < MAX_FAILED:
+        candidates = map.rng.uniform([map.x_min, map.y_min], [map.x_max, map.y_max], size=(batch_size, 2))
+        candidates = candidates[clear_of_obstacles(map, candidates) & grid.far_enough(candidates)]
+        candidates = resolve_conflicts(candidates, map.d_min_aa)[:n - grid.n]
+        grid.insert(candidates)
+        failed = 0 if len(candidates) else failed + 1
+    return grid.points.copy()
+
+def generate_agents_uniform(map):
     iter,j_max,idx_j_max = 0,0,0
     d_closest_agents,id_closest_agents = np.inf,[0,0]
     rectangles = [create_bigger_rectangle(o,0) for o in map.all_obstacles]
+    candidates = candidate_stream(map.rng, [map.x_min, map.y_min], [map.x_max, map.y_max])
+    positions = np.empty((map.n_agents, 2))
+    map.agents.clear()
+    map.agents.reserve(map.n_agents)
     for i in range(map.n_agents):
         j=0
         while True:
             overlap = False
-            x = np.random.uniform(map.x_min, map.x_max)
-            y = np.random.uniform(map.y_min, map.y_max)
-            pos = np.array([[x],[y]])
+            x, y = next(candidates)
 
-            if not np.any(map.all_agents):
+            if i == 0:
                 for rect in rectangles:
                     if rectangle_circle_overlap(rect,[x,y,map.d_min_ao]):
                         overlap = True
@@ -124,12 +281,11 @@ def generate_agents(map):
                     j += 1
                     continue
                 iter += j+1
-                a = Agent(id=i,p=pos)
-                map.all_agents = np.append(map.all_agents,a)
-                map.init_positions_array = np.array([[x,y]])
+                map.agents.append(id=i, group=0, r=DRONE_SIZE/2)
+                positions[i] = x, y
                 break
 
-            dists_sq = np.sum((map.init_positions_array - np.array([x,y]))**2,axis=1)
+            dists_sq = np.sum((positions[:i] - np.array([x,y]))**2,axis=1)
             d_closest = np.sqrt(np.min(dists_sq))
             id_closest = int(np.argmin(dists_sq))
 
@@ -151,25 +307,21 @@ def generate_agents(map):
                 if d_closest_agents > d_closest:
                     d_closest_agents = d_closest
                     id_closest_agents = [i,id_closest]
-                a = Agent(id=i,p=pos)
-                map.all_agents = np.append(map.all_agents,a)
-                map.init_positions_array = np.append(map.init_positions_array,[[x,y]],axis=0)
+                map.agents.append(id=i, group=0, r=DRONE_SIZE/2)
+                positions[i] = x, y
                 break
     #     print(i,iter,j_max,idx_j_max,d_closest_agents,id_closest_agents)
     print(iter,j_max,idx_j_max,d_closest_agents,id_closest_agents)
+    map.init_positions_array = positions
+    map.init_trajectory()
         
+def candidate_stream(rng, low, high, block=CANDIDATE_BLOCK):
+    """ Endless uniform (x, y) candidates, drawn from rng a block at a time """
+    while True:
+        yield from rng.uniform(low, high, size=(block, 2))
+
 def reset_to_init_pos(map):
-    for i, a in enumerate(map.all_agents):
-        x,y = map.init_positions_array[i]
-        a.p = np.array([[x],[y]])
-        a.v = np.array([[0],[0]])
-        a.a = np.array([[0],[0]])
-        a.p_field = np.array([[],[]])
-        a.v_field = np.array([[],[]])
-        a.p_target = np.array([[],[]])
-        a.v_target = np.array([[],[]])
-        a.p_des = np.array([[],[]])
-        a.v_des = np.array([[],[]])
+    map.init_trajectory()
 
 def create_bigger_rectangle(obst,d_min):
     x_min = obst.x_min - d_min
@@ -0,0 +1,61 @@
+import time
+
+PHASES      = ("distances", "groups", "target", "field", "obstacles", "v_des", "integration", "history", "collisions")
+COUNTERS    = ("steps", "pairs", "obstacle_tests", "clipped")
+
+class StepStats:
+    """ Wall time per phase of append_vel_pos and its helpers, plus counters of the work done:
+        agent pairs evaluated, agent/obstacle tests and agents clipped at v_max.
+        Disabled by default; the step functions then only ever see NULL_STATS """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.t_last = time.perf_counter()
+
+    def active(self):
+        return self if self.enabled else NULL_STATS
+
+    def start(self):
+        self.t_last = time.perf_counter()
+
+    def lap(self, phase):
+        """ Charge the time since the previous start/lap to phase """
+        now = time.perf_counter()
+        self.times[phase] += now - self.t_last
+        self.t_last = now
+
+    def count(self, counter, n=1):
+        self.counts[counter] += int(n)
+
+    def summary(self):
+        """ Milliseconds and counts per step """
+        steps = max(self.counts["steps"], 1)
+        per_step = {phase: 1e3*t/steps for phase, t in self.times.items()}
+        per_step.update({k: n/steps for k, n in self.counts.items() if k != "steps"})
+        return per_step
+
+    def format(self):
+        steps, total = self.counts["steps"], sum(self.times.values())
+        lines = [f"{steps} steps, {1e3*total/max(steps, 1):.3f} ms/step"]
+        for phase, t in self.times.items():
+            lines.append(f"  {phase:<12} {1e3*t/max(steps, 1):8.3f} ms  {100*t/total if total else 0:5.1f} %")
+        for k, n in self.counts.items():
+            if k != "steps":
+                lines.append(f"  {k:<14} {n/max(steps, 1):10.1f} /step")
+        return "\n".join(lines)
+
+class NullStats:
+    """ Stand-in passed around while stats are disabled, every hook is a no-op """
+    enabled = False
+    def start(self):
+        pass
+    def lap(self, phase):
+        pass
+    def count(self, counter, n=1):
+        pass
+
+NULL_STATS = NullStats()
@@ -1,15 +1,18 @@
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
-from PyQt6.QtWidgets import QApplication, QMainWindow, QPushButton, QVBoxLayout, QWidget, QInputDialog
+from PyQt6.QtWidgets import QApplication, QMainWindow, QPushButton, QVBoxLayout, QWidget, QInputDialog, QLabel, QCheckBox
 from PyQt6.QtCore import QTimer
 import ast
+import threading
+import time
 import matplotlib.pyplot as plt
-import matplotlib.patches as patches
 import numpy as np
 
 from classes import Map
 from initialize_map import init_map, reset_to_init_pos
-from velocity_control import append_vel_pos
-from plots import animate_map, save_anim
+from export import export_animation
+from renderer import MapRenderer
+from sim_worker import SimulationWorker
+from velocity_control import compute_com
 
 def parse_kwargs(s):
     """ Safely parse 'a=1, b=False' → {'a':1, 'b':False} """
@@ -32,6 +35,7 @@ class MapWindow(QMainWindow):
         self.map = self.create_map_via_dialog()
         init_map(self.map)
         self.init_ui()
+        self.start_worker()
 
     def create_map_via_dialog(self):
         text, ok = QInputDialog.getText(
@@ -60,7 +64,15 @@ class MapWindow(QMainWindow):
         self.is_playing = False
         reset_btn = QPushButton("Reset")
         reinit_btn = QPushButton("Reinitialize")
+        checkpoint_btn = QPushButton("Checkpoint")
+        self.rewind_btn = QPushButton("Rewind")
+        self.rewind_btn.setEnabled(False)
+        self.checkpoint_blob = None
         save_btn = QPushButton("Save")
+        self.realtime_box = QCheckBox("Real time")
+        self.realtime_box.setChecked(True)
+        self.stats_box = QCheckBox("Profile step phases")
+        self.status_label = QLabel()
 
         # Layout
         layout = QVBoxLayout()
@@ -68,7 +80,12 @@ class MapWindow(QMainWindow):
         layout.addWidget(start_pause_btn)
         layout.addWidget(reset_btn)
         layout.addWidget(reinit_btn)
+        layout.addWidget(checkpoint_btn)
+        layout.addWidget(self.rewind_btn)
         layout.addWidget(save_btn)
+        layout.addWidget(self.realtime_box)
+        layout.addWidget(self.stats_box)
+        layout.addWidget(self.status_label)
 
         container = QWidget()
         container.setLayout(layout)
@@ -78,89 +95,106 @@ class MapWindow(QMainWindow):
         start_pause_btn.clicked.connect(self.start_pause_sim)
         reset_btn.clicked.connect(self.reset_sim)
         reinit_btn.clicked.connect(self.reinitialize_sim)
+        checkpoint_btn.clicked.connect(self.checkpoint_sim)
+        self.rewind_btn.clicked.connect(self.rewind_sim)
         save_btn.clicked.connect(self.save)
+        self.realtime_box.toggled.connect(self.set_realtime)
+        self.stats_box.toggled.connect(self.set_stats)
 
-        # Timer for updates
+        # The simulation runs on a SimulationWorker thread, the timer only redraws its latest snapshot
         self.map_initialized = False
-        self.map_timer = QTimer()
-        self.map_timer.timeout.connect(self.update_map)
+        self.renderer = None
         self.plot_timer = QTimer()
         self.plot_timer.timeout.connect(self.update_map_plot)
 
+    def start_worker(self):
+        self.worker = SimulationWorker(self.map, realtime=self.realtime_box.isChecked())
+        self.snapshot_positions = np.zeros_like(self.worker.buffer.positions[0])
+        self.snapshot_com = np.zeros_like(self.worker.buffer.com[0])
+        self.frame_times, self.overlay_time = [], 0.0
+        self.set_stats(self.stats_box.isChecked())
+        self.worker.start()
+
+    def stop_sim(self):
+        self.is_playing, self.map_initialized = False, False
+        self.plot_timer.stop()
+        self.worker.stop()
+
+    def set_realtime(self, checked):
+        self.worker.realtime = checked
+
+    def set_stats(self, checked):
+        self.map.stats.reset()
+        self.map.stats.enabled = checked
+        if self.renderer is not None and not checked:
+            self.renderer.set_overlay("")
+
     def start_pause_sim(self):
         if self.is_playing:
             self.is_playing = False
-            self.map_timer.stop()
+            self.worker.pause()
             self.plot_timer.stop()
         else:
             self.is_playing = True
-            self.map_timer.start(int(self.map.dt*1000))  # update every dt ms (100 Hz by default)
+            self.worker.play()
             self.plot_timer.start(30)                # update every 30 ms (~33 fps)
 
     def reset_sim(self):
-        self.is_playing, self.map_initialized = False, False
-        self.map_timer.stop()
-        self.plot_timer.stop()
+        self.stop_sim()
         reset_to_init_pos(self.map)
+        self.start_worker()
         
     def reinitialize_sim(self):
-        self.is_playing, self.map_initialized = False, False
-        self.map_timer.stop()
-        self.plot_timer.stop()
+        self.stop_sim()
         self.map = self.create_map_via_dialog()
         init_map(self.map)
+        self.checkpoint_blob = None
+        self.rewind_btn.setEnabled(False)
+        self.start_worker()
 
-    def update_map(self):
-        append_vel_pos(self.map)
+    def checkpoint_sim(self):
+        self.worker.pause()
+        self.checkpoint_blob = self.map.checkpoint()
+        if self.is_playing:
+            self.worker.play()
+        self.rewind_btn.setEnabled(True)
+        self.rewind_btn.setText(f"Rewind to step {self.map.trajectory.n_steps}")
+
+    def rewind_sim(self):
+        """ Back to the last checkpoint, keeping the history before it; the run is paused there """
+        self.stop_sim()
+        self.map.restore(self.checkpoint_blob)
+        self.start_worker()
+        positions = self.map.trajectory.row("p", -1)
+        _, group_idx, counts = self.map.group_index()
+        self.worker.buffer.publish(positions, compute_com(positions, group_idx, counts), self.map.trajectory.n_steps)
+        self.update_map_plot()
 
     def update_map_plot(self):
+        step = self.worker.buffer.read(self.snapshot_positions, self.snapshot_com)
+        if step < 0:
+            return
         if not self.map_initialized:
             self.initialize_map_plot()
-            self.canvas.draw_idle()
-        for i, a in enumerate(self.map.all_agents):
-            x, y = a.p[0][-1], a.p[1][-1]
-            self.agent_circles[i].center = (x, y)
-        if not self.map.C_O_M.size:
-            return
-        for i, c in enumerate(self.map.C_O_M[-1]):
-            x, y = c
-            self.center_circles[i].center = (x, y)
-        self.canvas.draw_idle()
+        self.renderer.update(self.snapshot_positions, self.snapshot_com)
+        self.renderer.blit()
+        self.update_status(step)
+
+    def update_status(self, step):
+        now = time.perf_counter()
+        self.frame_times = [t for t in self.frame_times if now - t < 1.0] + [now]
+        self.status_label.setText(f"step {step}   sim: {self.worker.steps_per_s:.0f} steps/s   "
+                                  f"render: {len(self.frame_times)} fps")
+        if self.map.stats.enabled and now - self.overlay_time >= 1.0:
+            self.overlay_time = now
+            self.renderer.set_overlay(self.map.stats.format())
 
     def initialize_map_plot(self):
+        if self.renderer is not None:
+            self.renderer.remove()
         self.ax.clear()
         self.map_initialized = True
-
-        self.agent_circles = []
-        for a in self.map.all_agents:
-            circle = patches.Circle(
-                (a.p[0][0], a.p[1][0]),
-                radius=a.r,
-                color='blue',
-                alpha=0.6)
-            self.ax.add_patch(circle)
-            self.agent_circles.append(circle)
-
-        for o in self.map.all_obstacles:
-            rect = patches.Rectangle(
-                (o.x_min, o.y_min), # bottom left
-                o.x_max - o.x_min,  # width
-                o.y_max - o.y_min,  # height
-                linewidth=1.5,
-                edgecolor='red',
-                facecolor='none'    # transparent inside
-            )
-            self.ax.add_patch(rect)
-
-        self.center_circles = []
-        for c in self.map.C_O_M[0]:
-            circle = patches.Circle(
-                    (c[0], c[1]), 
-                    radius=2*self.map.all_agents[0].r, 
-                    color='green', 
-                    alpha=0.6)
-            self.center_circles.append(circle)
-            self.ax.add_patch(circle)
+        self.renderer = MapRenderer.for_map(self.ax, self.map, self.snapshot_positions, self.snapshot_com)
 
         self.plot_x_min, self.plot_x_max = self.map.x_min - 0.25*self.map.len_x, self.map.x_max + 0.25*self.map.len_x
         self.plot_y_min, self.plot_y_max = self.map.y_min - 0.25*self.map.len_y, self.map.y_max + 0.25*self.map.len_y
@@ -169,13 +203,20 @@ class MapWindow(QMainWindow):
 
         self.ax.set_aspect('equal')
         self.ax.grid(True)
+        self.renderer.enable_blit(self.canvas)
 
     def save(self):
-        self.map_timer.stop()
+        self.is_playing = False
+        self.worker.pause()
         self.plot_timer.stop()
         print("Saving animation...")
         rect = [self.plot_x_min, self.plot_y_min, self.plot_x_max, self.plot_y_max]
-        save_anim(animate_map(self.map,rectangle=rect))
+        # Frames are rendered on a process pool; the thread only keeps the window responsive meanwhile
+        threading.Thread(target=export_animation, args=(self.map,), kwargs={"rectangle": rect}, daemon=True).start()
+
+    def closeEvent(self, event):
+        self.worker.stop()
+        super().closeEvent(event)
 
 if __name__ == "__main__":
     import sys
@@ -0,0 +1,109 @@
+import numpy as np
+from numba import njit, prange
+
+# Compiled counterpart of velocity_control.compute_v_field_all: one fused pass per agent, parallel over
+# agents, without the (N, N, 2) temporaries. cache=True keeps the machine code in __pycache__, so only
+# the very first run pays for compilation (set NUMBA_CACHE_DIR to move it).
+
+@njit(cache=True)
+def agent_field(positions, i, r_rep, k_rep, r_att, k_att):
+    """ (rep_x, rep_y, att_x, att_y) on agent i from every other agent """
+    n = positions.shape[0]
+    xi, yi = positions[i, 0], positions[i, 1]
+    rep_x = rep_y = att_x = att_y = 0.0
+    for j in range(n):
+        dx, dy = positions[j, 0] - xi, positions[j, 1] - yi
+        dist = np.sqrt(dx*dx + dy*dy)
+        if 0 < dist < r_rep:
+            coef = k_rep * (dist - r_rep) / dist
+            rep_x += coef * dx
+            rep_y += coef * dy
+        if dist > r_att:
+            coef = k_att/n * (dist - r_att) / dist
+            att_x += coef * dx
+            att_y += coef * dy
+    return rep_x, rep_y, att_x, att_y
+
+@njit(parallel=True, cache=True)
+def v_field_kernel(positions, r_rep, k_rep, r_att, k_att, bounds, first_cells, starts, ids, origin, cell_size, shape, rings):
+    n = positions.shape[0]
+    v_field = np.zeros((n, 2))
+    tests = np.zeros(n, dtype=np.int64)
+    for i in prange(n):
+        xi, yi = positions[i, 0], positions[i, 1]
+        rep_x, rep_y, att_x, att_y = agent_field(positions, i, r_rep, k_rep, r_att, k_att)
+
+        # Same candidates as ObstacleGrid.query_radius; an obstacle listed in several cells of the window
+        # is only handled in the first of them, which replaces the np.unique over pairs
+        obst_x = obst_y = 0.0
+        if len(bounds):
+            ci = min(max(int(np.floor((xi - origin[0]) / cell_size)), 0), shape[0] - 1)
+            cj = min(max(int(np.floor((yi - origin[1]) / cell_size)), 0), shape[1] - 1)
+            lo_i, lo_j = max(ci - rings, 0), max(cj - rings, 0)
+            for a in range(lo_i, min(ci + rings, shape[0] - 1) + 1):
+                for b in range(lo_j, min(cj + rings, shape[1] - 1) + 1):
+                    key = a*shape[1] + b
+                    for s in range(starts[key], starts[key+1]):
+                        k = ids[s]
+                        if a != max(first_cells[k, 0], lo_i) or b != max(first_cells[k, 1], lo_j):
+                            continue
+                        dx = min(max(xi, bounds[k, 0]), bounds[k, 2]) - xi
+                        dy = min(max(yi, bounds[k, 1]), bounds[k, 3]) - yi
+                        dist_sq = dx*dx + dy*dy
+                        if dist_sq < r_rep*r_rep:
+                            tests[i] += 1
+                            dist = np.sqrt(dist_sq)
+                            if dist > 0:
+                                coef = 1.5 * k_rep * (dist - r_rep) / dist
+                                obst_x += coef * dx
+                                obst_y += coef * dy
+        v_field[i, 0] = rep_x + att_x + obst_x
+        v_field[i, 1] = rep_y + att_y + obst_y
+    return v_field, tests
+
+@njit(parallel=True, cache=True)
+def ensemble_field_kernel(positions, bounds, valid, r_rep, k_rep, r_att, k_att):
+    """ Dense field of (B, N, 2) positions against padded (B, M, 4) obstacle bounds, parallel over all B*N agents """
+    n_maps, n = positions.shape[0], positions.shape[1]
+    v_field = np.zeros((n_maps, n, 2))
+    for bi in prange(n_maps*n):
+        b, i = bi // n, bi % n
+        xi, yi = positions[b, i, 0], positions[b, i, 1]
+        rep_x, rep_y, att_x, att_y = agent_field(positions[b], i, r_rep, k_rep, r_att, k_att)
+        obst_x = obst_y = 0.0
+        for k in range(bounds.shape[1]):
+            if not valid[b, k]:
+                continue
+            dx = min(max(xi, bounds[b, k, 0]), bounds[b, k, 2]) - xi
+            dy = min(max(yi, bounds[b, k, 1]), bounds[b, k, 3]) - yi
+            dist = np.sqrt(dx*dx + dy*dy)
+            if 0 < dist < r_rep:
+                coef = 1.5 * k_rep * (dist - r_rep) / dist
+                obst_x += coef * dx
+                obst_y += coef * dy
+        v_field[b, i, 0] = rep_x + att_x + obst_x
+        v_field[b, i, 1] = rep_y + att_y + obst_y
+    return v_field
+
+def compute_v_field(positions, obstacle_index, r_rep, k_rep, r_att, k_att, stats, obstacle_field=None):
+    """ With an obstacle_field (see velocity_control.get_obstacle_field) the kernel skips the obstacles,
+        which are then looked up in the field """
+    starts, ids, first_cells = obstacle_index.cell_index()
+    rings = int(np.ceil(r_rep / obstacle_index.cell_size))
+    bounds = obstacle_index.bounds if obstacle_field is None else obstacle_index.bounds[:0]
+    v_field, tests = v_field_kernel(np.ascontiguousarray(positions, dtype=float), r_rep, k_rep, r_att, k_att,
+                                    np.ascontiguousarray(bounds), first_cells, starts, ids,
+                                    obstacle_index.origin, float(obstacle_index.cell_size), obstacle_index.shape, rings)
+    if stats.enabled:
+        stats.count("pairs", len(positions)*(len(positions)-1))
+        stats.count("obstacle_tests", tests.sum())
+    stats.lap("field")
+    if obstacle_field is not None:
+        v_field += k_rep * obstacle_field.lookup(positions)
+        stats.lap("obstacles")
+    return v_field
+
+def warm_up():
+    """ Start the threading layer from the calling thread. When the first parallel kernel runs on a worker
+        thread instead (sim_worker.SimulationWorker), tbb keeps a pool that hangs the interpreter at exit """
+    ensemble_field_kernel(np.zeros((1, 1, 2)), np.zeros((1, 0, 4)), np.zeros((1, 0), dtype=bool), 0.0, 0.0, 0.0, 0.0)
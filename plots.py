@@ -1,48 +1,24 @@
 import os
 import numpy as np
 import matplotlib.pyplot as plt
-import matplotlib.patches as patches
 from matplotlib.animation import FuncAnimation, PillowWriter
 
+from renderer import MapRenderer
+from storage import load_map
+
 MAX_FRAMES = 200
 
 def plot_map(map, rectangle=None, t_idx=0):
-    agents, obstacles, center_of_mass = map.all_agents, map.all_obstacles, map.C_O_M
+    if isinstance(map, (str, os.PathLike)):
+        map = load_map(map)
+    positions, center_of_mass = map.trajectory["p"], map.C_O_M
     if rectangle is None:
         x_min, y_min, x_max, y_max = map.x_min, map.y_min, map.x_max, map.y_max
     else:
         x_min, y_min, x_max, y_max = rectangle
 
     fig, ax = plt.subplots(figsize=(6, 6))
-
-    for a in agents:
-        circle = patches.Circle(
-            (a.p[0][t_idx], a.p[1][t_idx]),
-            radius=a.r,
-            facecolor='blue',
-            edgecolor='k',
-            alpha=0.6
-        )
-        ax.add_patch(circle)
-
-    for o in obstacles:
-        rect = patches.Rectangle(
-            (o.x_min, o.y_min), # bottom left
-            o.x_max - o.x_min,  # width
-            o.y_max - o.y_min,  # height
-            linewidth=1.5,
-            edgecolor='red',
-            facecolor='none'    # transparent inside
-        )
-        ax.add_patch(rect)
-
-    for c in center_of_mass[t_idx]:
-        circle = patches.Circle(
-                (c[0], c[1]), 
-                radius=2*a.r, 
-                color='green', 
-                alpha=0.6)
-        ax.add_patch(circle)
+    MapRenderer.for_map(ax, map, positions[t_idx], center_of_mass[t_idx], animated=False, agent_edgecolor='k')
 
     ax.set_xlim(x_min, x_max)
     ax.set_ylim(y_min, y_max)
@@ -55,13 +31,15 @@ def plot_map(map, rectangle=None, t_idx=0):
     plt.show()
 
 def animate_map(map, frame_min=0, frame_max=-1, rectangle=None, interval=None, downscale=True):
-    agents, obstacles, center_of_mass, interval = map.all_agents, map.all_obstacles, map.C_O_M, map.dt
+    if isinstance(map, (str, os.PathLike)):
+        map = load_map(map)
+    positions, center_of_mass, interval = map.trajectory["p"], map.C_O_M, map.dt
     if rectangle is None:
         x_min, y_min, x_max, y_max = map.x_min, map.y_min, map.x_max, map.y_max
     else:
         x_min, y_min, x_max, y_max = rectangle
     if frame_max == -1:
-        frame_max = len(agents[0].p[0])
+        frame_max = len(center_of_mass)
     n_frames = frame_max - frame_min
     if downscale and n_frames > MAX_FRAMES:
        scaling = (n_frames // MAX_FRAMES)
@@ -70,47 +48,11 @@ def animate_map(map, frame_min=0, frame_max=-1, rectangle=None, interval=None, d
         scaling = 1
 
     fig, ax = plt.subplots(figsize=(6,6))
-    ax.set_xlim(x_min, x_max)
-    ax.set_ylim(y_min, y_max)
-
-    agents_circles = []
-    for a in agents:
-        circle = patches.Circle(
-                (a.p[0][frame_min], a.p[1][frame_min]), 
-                radius=a.r, 
-                color='blue', 
-                alpha=0.6)
-        agents_circles.append(circle)
-        ax.add_patch(circle)
-
-    for o in obstacles:
-        rect = patches.Rectangle(
-            (o.x_min, o.y_min), # bottom left
-            o.x_max - o.x_min,  # width
-            o.y_max - o.y_min,  # height
-            linewidth=1.5,
-            edgecolor='red',
-            facecolor='none'    # transparent inside
-        )
-        ax.add_patch(rect)
-
-    center_circles = []
-    for c in center_of_mass[0]:
-        circle = patches.Circle(
-                (c[0], c[1]), 
-                radius=2*a.r, 
-                color='green', 
-                alpha=0.6)
-        center_circles.append(circle)
-        ax.add_patch(circle)
+    renderer = MapRenderer.for_map(ax, map, positions[frame_min], center_of_mass[frame_min])
 
     def update(frame):
-        for i, c in enumerate(agents_circles):
-            c.center = (agents[i].p[0][frame*scaling], agents[i].p[1][frame*scaling])
-        swarm_centers = center_of_mass[frame*scaling]
-        for i, c in enumerate(center_circles):
-            c.center = (swarm_centers[i][0], swarm_centers[i][1])
-        return agents_circles + center_circles
+        t = frame_min + frame*scaling
+        return renderer.update(positions[t], center_of_mass[t])
     
     ax.set_xlim(x_min, x_max)
     ax.set_ylim(y_min, y_max)
@@ -120,7 +62,7 @@ def animate_map(map, frame_min=0, frame_max=-1, rectangle=None, interval=None, d
     ax.set_aspect('equal', adjustable='box')
     ax.grid(True)
 
-    anim = FuncAnimation(fig, update, frames=n_frames, interval=1000*interval*scaling, blit=False)
+    anim = FuncAnimation(fig, update, frames=n_frames, interval=1000*interval*scaling, blit=True)
     return(anim)
 
 def save_anim(anim, folder="my_animations"):
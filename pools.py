@@ -0,0 +1,11 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# A process forked after a numba kernel ran inherits a dead threading layer and its pool never shuts down,
+# so process pools (export, sweep) start their workers from a fork server, or by spawning where there is none
+POOL_CONTEXT = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+def process_pool(max_workers=None):
+    """ ProcessPoolExecutor on POOL_CONTEXT. Its workers import the calling script again, so a script that
+        starts one needs an `if __name__ == "__main__":` guard, or every task fails with BrokenProcessPool """
+    return ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context(POOL_CONTEXT))
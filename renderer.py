@@ -0,0 +1,79 @@
+import numpy as np
+import matplotlib.patches as patches
+from matplotlib.collections import EllipseCollection, PatchCollection
+
+class MapRenderer:
+    """ Draws a Map on ax with one collection per kind of object: obstacles are a static
+        PatchCollection kept in a cached background, agents and centers of mass are
+        EllipseCollections whose offsets are replaced from position arrays in a single call """
+    def __init__(self, ax, obstacle_bounds, radii, positions, center_of_mass, animated=True, agent_edgecolor='none'):
+        self.ax = ax
+        radii = np.asarray(radii, dtype=float)
+        r_com = 2*radii[0] if len(radii) else 0
+
+        rects = [patches.Rectangle((x_min, y_min), x_max - x_min, y_max - y_min)
+                 for x_min, y_min, x_max, y_max in obstacle_bounds]
+        self.obstacles = PatchCollection(rects, linewidth=1.5, edgecolor='red', facecolor='none')
+        ax.add_collection(self.obstacles)
+
+        self.agents = EllipseCollection(2*radii, 2*radii, np.zeros_like(radii), units='xy',
+                                        offsets=np.asarray(positions).reshape(-1, 2), offset_transform=ax.transData,
+                                        facecolor='blue', edgecolor=agent_edgecolor, alpha=0.6, animated=animated)
+        ax.add_collection(self.agents)
+        n_groups = len(np.asarray(center_of_mass).reshape(-1, 2))
+        self.centers = EllipseCollection(np.full(n_groups, 2*r_com), np.full(n_groups, 2*r_com), np.zeros(n_groups),
+                                         units='xy', offsets=np.asarray(center_of_mass).reshape(-1, 2),
+                                         offset_transform=ax.transData, facecolor='green', edgecolor='none',
+                                         alpha=0.6, animated=animated)
+        ax.add_collection(self.centers)
+        self.overlay = ax.text(0.01, 0.99, "", transform=ax.transAxes, va='top', ha='left', family='monospace',
+                               fontsize=7, animated=animated, bbox=dict(facecolor='white', alpha=0.7, edgecolor='none'))
+        self.overlay.set_visible(False)
+        self.background = None
+        self.draw_cid = None
+
+    @classmethod
+    def for_map(cls, ax, map, positions, center_of_mass, **kwargs):
+        return cls(ax, map.obstacle_bounds, map.agents["r"], positions, center_of_mass, **kwargs)
+
+    @property
+    def artists(self):
+        return [self.agents, self.centers, self.overlay]
+
+    def update(self, positions, center_of_mass):
+        self.agents.set_offsets(positions)
+        self.centers.set_offsets(center_of_mass)
+        return self.artists
+
+    def set_overlay(self, text):
+        """ Text drawn over the top left corner of the axes, hidden when empty """
+        self.overlay.set_text(text)
+        self.overlay.set_visible(bool(text))
+
+    def enable_blit(self, canvas):
+        """ Cache everything but the moving collections and recache whenever the canvas is fully redrawn """
+        self.canvas = canvas
+        if self.draw_cid is None:
+            self.draw_cid = canvas.mpl_connect('draw_event', self.on_draw)
+        canvas.draw()
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.draw_artists()
+
+    def draw_artists(self):
+        for artist in self.artists:
+            self.ax.draw_artist(artist)
+
+    def blit(self):
+        if self.background is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_artists()
+        self.canvas.blit(self.ax.bbox)
+
+    def remove(self):
+        if self.draw_cid is not None:
+            self.canvas.mpl_disconnect(self.draw_cid)
+            self.draw_cid = None
@@ -0,0 +1,105 @@
+import threading
+import time
+
+import numpy as np
+
+from velocity_control import append_vel_pos, numba_kernels
+
+RATE_WINDOW = 1.0   # seconds over which steps/s is averaged
+
+class SnapshotBuffer:
+    """ Lock-free double buffer of the latest positions and centers of mass.
+        The writer fills the back slot and publishes it by flipping `front`; each slot carries a
+        sequence number that is odd while being written, so a reader retries instead of tearing """
+    def __init__(self, n_agents, n_groups):
+        self.positions = np.zeros((2, n_agents, 2))
+        self.com = np.zeros((2, n_groups, 2))
+        self.steps = [-1, -1]
+        self.seq = [0, 0]
+        self.front = 0
+
+    def publish(self, positions, com, step):
+        back = 1 - self.front
+        self.seq[back] += 1
+        self.positions[back] = positions
+        self.com[back] = com
+        self.steps[back] = step
+        self.seq[back] += 1
+        self.front = back
+
+    def read(self, positions, com):
+        """ Copy the newest snapshot into positions/com and return its step (-1 if nothing published yet) """
+        while True:
+            i = self.front
+            s = self.seq[i]
+            if s % 2:
+                continue
+            np.copyto(positions, self.positions[i])
+            np.copyto(com, self.com[i])
+            step = self.steps[i]
+            if self.seq[i] == s:
+                return step
+
+class SimulationWorker(threading.Thread):
+    """ Steps a Map on its own thread, either paced to map.dt (realtime) or as fast as possible,
+        and publishes every step to a SnapshotBuffer for the renderer """
+    def __init__(self, map, realtime=True, **step_kwargs):
+        super().__init__(daemon=True)
+        self.map = map
+        self.realtime = realtime
+        self.step_kwargs = step_kwargs
+        self.buffer = SnapshotBuffer(len(map.all_agents), len(map.all_groups))
+        self.steps_per_s = 0.0
+        self.playing = threading.Event()
+        self.idle = threading.Event()
+        self.idle.set()
+        self.stopped = False
+
+    def start(self):
+        if numba_kernels is not None:   # on the caller's thread, see numba_kernels.warm_up
+            numba_kernels.warm_up()
+        super().start()
+
+    def run(self):
+        try:
+            self.loop()
+        finally:
+            self.stopped = True
+            self.idle.set()
+
+    def loop(self):
+        rate_t0, rate_steps = time.perf_counter(), 0
+        next_t = time.perf_counter()
+        while not self.stopped:
+            self.idle.clear()
+            if not self.playing.is_set():
+                self.idle.set()
+                self.playing.wait(0.1)
+                next_t = rate_t0 = time.perf_counter()
+                rate_steps = 0
+                continue
+            append_vel_pos(self.map, **self.step_kwargs)
+            traj = self.map.trajectory
+            self.buffer.publish(traj.row("p", -1), traj.row("C_O_M", -1), traj.n_steps)
+            rate_steps += 1
+            now = time.perf_counter()
+            if now - rate_t0 >= RATE_WINDOW:
+                self.steps_per_s = rate_steps / (now - rate_t0)
+                rate_t0, rate_steps = now, 0
+            if self.realtime:
+                next_t = max(next_t + self.map.dt, now - self.map.dt)   # don't try to catch up after a stall
+                time.sleep(max(0.0, next_t - now))
+
+    def play(self):
+        self.playing.set()
+
+    def pause(self):
+        """ Stop stepping and wait for the current step to finish, after which the map is safe to read """
+        self.playing.clear()
+        self.idle.wait()
+
+    def stop(self):
+        self.stopped = True
+        self.playing.clear()
+        if self.is_alive():
+            self.join()
@@ -0,0 +1,117 @@
+import argparse
+import time
+
+from classes import Map, DT, STREAM_WINDOW
+from initialize_map import init_map
+from storage import save_map, start_stream, stop_stream
+from velocity_control import compute_step, integrate, record_step, V_MAX, R_REP, R_ATT, K_REP, K_ATT, K_TARGET
+from acceleration_control import integrate_acc, INTEGRATORS, K_V, A_MAX
+from collisions import EventLog
+
+PHASES = ("field", "integration", "bookkeeping")
+
+def run(map, n_steps, gains=None, vectorized=True, cell_list=None, backend=None, report_every=0,
+        integrator=None, k_v=K_V, a_max=A_MAX, tol=None):
+    """ Step map n_steps times as fast as possible, returning wall-clock seconds spent per phase.
+        With an integrator the acceleration controller is used, its extra field evaluations count as integration """
+    gains = gains or {}
+    timings = dict.fromkeys(PHASES, 0.0)
+    for k in range(n_steps):
+        t_idx = map.trajectory.n_steps
+        t0 = time.perf_counter()
+        step = compute_step(map, t_idx, vectorized=vectorized, cell_list=cell_list, backend=backend, **gains)
+        t1 = time.perf_counter()
+        if integrator is None:
+            p, v, a = integrate(map, t_idx), None, None
+        else:
+            p, v, a = integrate_acc(map, t_idx, step[-1], integrator, k_v, a_max, tol, gains, cell_list, backend)
+        t2 = time.perf_counter()
+        record_step(map, p, *step, v=v, a=a)
+        t3 = time.perf_counter()
+        timings["field"] += t1 - t0
+        timings["integration"] += t2 - t1
+        timings["bookkeeping"] += t3 - t2
+        if report_every and (k+1) % report_every == 0:
+            print(f"step {k+1}/{n_steps}: {(k+1)/sum(timings.values()):.1f} steps/s")
+    return timings
+
+def print_timings(timings, n_steps):
+    total = sum(timings.values())
+    print(f"{n_steps} steps in {total:.3f} s: {n_steps/total if total else float('inf'):.1f} steps/s")
+    for phase in PHASES:
+        share = timings[phase]/total if total else 0
+        print(f"  {phase:<12} {1e3*timings[phase]/max(n_steps, 1):8.3f} ms/step  {100*share:5.1f} %")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run a swarm simulation without the GUI")
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--out", default=None, help="write the run to this directory (see storage.py)")
+    parser.add_argument("--stream", action="store_true",
+                        help="stream chunks to --out while running, keeping only --window steps in RAM")
+    parser.add_argument("--window", type=int, default=STREAM_WINDOW)
+    parser.add_argument("--report_every", type=int, default=0)
+    parser.add_argument("--reference", action="store_true", help="use the per-agent reference step")
+    parser.add_argument("--cell_list", type=int, choices=(0, 1), default=None,
+                        help="force the cell-list field on/off (default: by agent count)")
+    parser.add_argument("--backend", choices=("numpy", "numba"), default=None,
+                        help="kernel backend of the vectorized step (default: numba if installed)")
+    parser.add_argument("--stats", action="store_true", help="print per-phase timings and counters (map.stats)")
+    parser.add_argument("--collisions", action="store_true",
+                        help="check every step for spacing and obstacle violations and print a summary")
+    parser.add_argument("--integrator", choices=list(INTEGRATORS), default=None,
+                        help="use the acceleration controller with this integrator (default: velocity controller)")
+    parser.add_argument("--tol", type=float, default=None, help="adaptive sub-stepping tolerance of --integrator")
+    map_args = parser.add_argument_group("Map")
+    map_args.add_argument("--n_agents", type=int, default=10)
+    map_args.add_argument("--n_obstacles", type=int, default=0)
+    map_args.add_argument("--map_walls", action="store_true")
+    map_args.add_argument("--fixed_map_size", action="store_true")
+    map_args.add_argument("--len_x", type=float, default=1)
+    map_args.add_argument("--len_y", type=float, default=1)
+    map_args.add_argument("--dt", type=float, default=DT)
+    map_args.add_argument("--field_resolution", type=float, default=None,
+                          help="look the obstacle repulsion up in a grid with this cell size instead of computing it")
+    gain_args = parser.add_argument_group("Controller gains")
+    for name, value in (("v_max", V_MAX), ("r_rep", R_REP), ("r_att", R_ATT),
+                        ("k_rep", K_REP), ("k_att", K_ATT), ("k_target", K_TARGET)):
+        gain_args.add_argument(f"--{name}", type=float, default=value)
+    gain_args.add_argument("--k_v", type=float, default=K_V)
+    gain_args.add_argument("--a_max", type=float, default=A_MAX)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    map = Map(fixed_map_size=args.fixed_map_size, map_walls=args.map_walls, n_agents=args.n_agents,
+              n_obstacles=args.n_obstacles, dt=args.dt, len_x=args.len_x, len_y=args.len_y, seed=args.seed,
+              field_resolution=args.field_resolution)
+    t0 = time.perf_counter()
+    init_map(map)
+    print(f"init_map: {time.perf_counter()-t0:.3f} s, {map.n_agents} agents, {len(map.all_obstacles)} obstacles")
+
+    gains = {name: getattr(args, name) for name in ("v_max", "r_rep", "r_att", "k_rep", "k_att", "k_target")}
+    cell_list = None if args.cell_list is None else bool(args.cell_list)
+    map.stats.enabled = args.stats
+    if args.collisions:
+        map.events = EventLog()
+    streaming = args.stream and args.out
+    if streaming:
+        start_stream(map, args.out, window=args.window)
+    timings = run(map, args.steps, gains, vectorized=not args.reference, cell_list=cell_list,
+                  backend=args.backend, report_every=args.report_every, integrator=args.integrator, k_v=args.k_v,
+                  a_max=args.a_max, tol=args.tol)
+    print_timings(timings, args.steps)
+    if args.stats:
+        print(map.stats.format())
+    if args.collisions:
+        for name, value in map.events.summary(len(map.agents)).items():
+            print(f"  {name:<22} {value}")
+    if streaming:
+        stop_stream(map)
+        print("Trajectories streamed to", args.out)
+    elif args.out:
+        save_map(map, args.out)
+        print("Trajectories saved as", args.out)
+
+if __name__ == "__main__":
+    main()
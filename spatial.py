@@ -0,0 +1,266 @@
+import numpy as np
+
+OFFSETS     = np.array([[di, dj] for di in (-1, 0, 1) for dj in (-1, 0, 1)])
+OFFSETS_5X5 = np.array([[di, dj] for di in range(-2, 3) for dj in range(-2, 3)])
+OFFSETS_6X6 = np.array([[di, dj] for di in range(-2, 4) for dj in range(-2, 4)])     # children of a parent's 3x3 block
+CHUNK_SIZE  = 2**20     # max number of pair/cell entries materialised at once
+MAX_NODES   = 2**22     # ObstacleField coarsens its cells to stay below this many grid nodes
+
+class CellList:
+    """ Uniform grid over a (N, 2) position array, agents sorted by cell """
+    def __init__(self, positions, cell_size):
+        self.positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        self.cell_size = cell_size
+        n = len(self.positions)
+        self.origin = self.positions.min(axis=0) if n else np.zeros(2)
+        self.ij = np.floor((self.positions - self.origin) / cell_size).astype(np.int64)
+        self.shape = self.ij.max(axis=0) + 1 if n else np.ones(2, dtype=np.int64)
+        keys = self.ij[:, 0] * self.shape[1] + self.ij[:, 1]
+        self.order = np.argsort(keys, kind="stable")
+        self.cell_keys, self.starts, self.counts = np.unique(keys[self.order], return_index=True, return_counts=True)
+        self.agent_cell = np.searchsorted(self.cell_keys, keys)
+        self.cell_ij = np.stack(np.divmod(self.cell_keys, self.shape[1]), axis=1)
+        self.cell_sums = (np.add.reduceat(self.positions[self.order], self.starts, axis=0) if n
+                          else np.empty((0, 2)))
+        self.neighbours = self.lookup(self.cell_ij[:, None, :] + OFFSETS[None, :, :])   # (C, 9), -1 if empty
+
+    def lookup(self, ij):
+        """ Index of the occupied cell at integer coordinates ij (..., 2), -1 where empty or outside """
+        return find_cells(self.cell_keys, self.shape, ij)
+
+    def pairs(self, radius=None):
+        """ Yield (i, j) index arrays of all ordered pairs i != j in neighbouring cells, in bounded chunks.
+            Every pair closer than cell_size is included; radius optionally drops the farther ones """
+        n = len(self.positions)
+        if not n:
+            return
+        block = self.neighbours[self.agent_cell]                       # (N, 9)
+        counts = np.where(block >= 0, self.counts[block], 0)
+        per_agent = counts.sum(axis=1)
+        agents_per_chunk = max(1, CHUNK_SIZE // max(1, int(per_agent.max())))
+        for lo in range(0, n, agents_per_chunk):
+            hi = min(n, lo + agents_per_chunk)
+            c = counts[lo:hi].ravel()
+            s = np.where(block[lo:hi] >= 0, self.starts[block[lo:hi]], 0).ravel()
+            i = np.repeat(np.arange(lo, hi), per_agent[lo:hi])
+            offsets = np.repeat(s - (np.cumsum(c) - c), c) + np.arange(c.sum())
+            j = self.order[offsets]
+            keep = i != j
+            if radius is not None:
+                keep &= np.sum((self.positions[j] - self.positions[i])**2, axis=1) < radius**2
+            yield i[keep], j[keep]
+
+    def block_aggregates(self):
+        """ Sum of positions and agent count over the 3x3 cell block around each agent """
+        valid = self.neighbours >= 0
+        sums = np.where(valid[:, :, None], self.cell_sums[self.neighbours], 0).sum(axis=1)
+        counts = np.where(valid, self.counts[self.neighbours], 0).sum(axis=1)
+        return sums[self.agent_cell], counts[self.agent_cell]
+
+    def far_unit_sums(self):
+        """ Approximate sum of unit vectors from each agent to every agent outside its 3x3 cell block.
+            The agent end of a pair is its cell's centre of mass and the far end the centre of mass of a cell
+            of levels(): at level l, the cells of side cell_size*2^l that are children of the 3x3 block around
+            the agent's parent cell but not next to its own cell (at most 27 per level). These lists cover every
+            far agent exactly once, always with a cell at least its own side away, so the direction error is
+            about (side/distance)^2 and the cost is O(C log C) in occupied cells instead of O(N^2) """
+        n_cells = len(self.cell_keys)
+        if not n_cells:
+            return np.empty((0, 2))
+        targets = self.cell_sums / self.counts[:, None]
+        unit_sums = np.zeros((n_cells, 2))
+        cells_per_chunk = max(1, CHUNK_SIZE // len(OFFSETS_6X6))
+        for level, (keys, shape, counts, coms) in enumerate(self.levels()):
+            own = self.cell_ij >> level
+            for lo in range(0, n_cells, cells_per_chunk):
+                hi = min(n_cells, lo + cells_per_chunk)
+                ij = 2*(own[lo:hi, None, :] >> 1) + OFFSETS_6X6[None, :, :]
+                src = find_cells(keys, shape, ij)
+                far = (src >= 0) & (np.max(np.abs(ij - own[lo:hi, None, :]), axis=2) > 1)
+                d = coms[src] - targets[lo:hi, None, :]
+                norm = np.linalg.norm(d, axis=2)
+                w = np.where(far, counts[src] / np.where(far, norm, 1), 0)
+                unit_sums[lo:hi] += np.sum(w[:, :, None] * d, axis=1)
+        return unit_sums[self.agent_cell]
+
+    def levels(self):
+        """ (cell_keys, shape, counts, centres of mass) of the occupied cells of side cell_size*2^l for
+            l = 0, 1, ... as long as two cells of a level can be more than one cell apart """
+        ij, counts, sums, shape = self.cell_ij, self.counts, self.cell_sums, self.shape
+        while True:
+            keys = ij[:, 0] * shape[1] + ij[:, 1]
+            yield keys, shape, counts, sums / counts[:, None]
+            if np.all(shape <= 2):
+                return
+            shape = (shape + 1) >> 1
+            parents, inverse = np.unique((ij >> 1)[:, 0] * shape[1] + (ij >> 1)[:, 1], return_inverse=True)
+            ij = np.stack(np.divmod(parents, shape[1]), axis=1)
+            counts = np.bincount(inverse, weights=counts)
+            sums = np.stack([np.bincount(inverse, weights=sums[:, k]) for k in range(2)], axis=1)
+
+def find_cells(cell_keys, shape, ij):
+    """ Index in the sorted flat keys cell_keys of the cell at integer coordinates ij (..., 2) of a grid of
+        the given shape, -1 where that cell is empty or outside """
+    inside = np.all((ij >= 0) & (ij < shape), axis=-1)
+    keys = ij[..., 0] * shape[1] + ij[..., 1]
+    idx = np.minimum(np.searchsorted(cell_keys, keys), max(len(cell_keys) - 1, 0))
+    found = inside & (cell_keys[idx] == keys) if len(cell_keys) else inside & False
+    return np.where(found, idx, -1)
+
+class ObstacleGrid:
+    """ Uniform grid over the map holding obstacle bounds (x_min, y_min, x_max, y_max), with incremental inserts """
+    def __init__(self, x_min, y_min, x_max, y_max, cell_size):
+        self.origin = np.array([x_min, y_min], dtype=float)
+        self.cell_size = cell_size
+        self.shape = np.maximum(np.ceil((np.array([x_max, y_max]) - self.origin) / cell_size), 1).astype(np.int64)
+        self.data = np.empty((16, 4))
+        self.first_cells = np.empty((16, 2), dtype=np.int64)     # lowest cell of each obstacle
+        self.n = 0
+        self.cells = {}         # flat cell key -> list of obstacle indices, used while inserting
+        self.csr = None         # (cell_starts, obstacle_ids), rebuilt lazily for batched queries
+
+    @property
+    def bounds(self):
+        return self.data[:self.n]
+
+    def cell_range(self, rect):
+        rect = np.asarray(rect, dtype=float)
+        lo = np.clip(np.floor((rect[:2] - self.origin) / self.cell_size), 0, self.shape - 1).astype(np.int64)
+        hi = np.clip(np.floor((rect[2:] - self.origin) / self.cell_size), 0, self.shape - 1).astype(np.int64)
+        return lo, hi
+
+    def insert(self, rect):
+        if self.n == len(self.data):
+            self.data = np.concatenate((self.data, np.empty_like(self.data)))
+            self.first_cells = np.concatenate((self.first_cells, np.empty_like(self.first_cells)))
+        self.data[self.n] = rect
+        lo, hi = self.cell_range(rect)
+        self.first_cells[self.n] = lo
+        for ci in range(lo[0], hi[0]+1):
+            for cj in range(lo[1], hi[1]+1):
+                self.cells.setdefault(ci*self.shape[1] + cj, []).append(self.n)
+        self.n += 1
+        self.csr = None
+        return self.n - 1
+
+    def candidates(self, rect):
+        lo, hi = self.cell_range(rect)
+        found = [self.cells.get(ci*self.shape[1] + cj, []) for ci in range(lo[0], hi[0]+1) for cj in range(lo[1], hi[1]+1)]
+        return np.unique(np.concatenate(found)).astype(np.int64) if found else np.empty(0, dtype=np.int64)
+
+    def overlaps(self, rect):
+        """ Same test as initialize_map.rectangles_overlap against every stored rectangle """
+        b = self.data[self.candidates(rect)]
+        x_min, y_min, x_max, y_max = rect
+        return bool(np.any(~((b[:, 2] < x_min) | (b[:, 0] > x_max) | (b[:, 3] < y_min) | (b[:, 1] > y_max))))
+
+    def build_csr(self):
+        n_cells = int(np.prod(self.shape))
+        keys = np.array(list(self.cells.keys()), dtype=np.int64)
+        counts = np.zeros(n_cells, dtype=np.int64)
+        counts[keys] = [len(self.cells[k]) for k in keys]
+        starts = np.concatenate(([0], np.cumsum(counts)))
+        ids = np.empty(starts[-1], dtype=np.int64)
+        for k in keys:
+            ids[starts[k]:starts[k+1]] = self.cells[k]
+        self.csr = (starts, ids)
+
+    def cell_index(self):
+        """ (cell_starts, obstacle_ids, first_cells) for compiled queries; first_cells[k] is the lowest cell of obstacle k """
+        if self.csr is None:
+            self.build_csr()
+        return self.csr[0], self.csr[1], self.first_cells[:self.n]
+
+    def query_radius(self, positions, radius):
+        """ (agent, obstacle) index pairs whose distance is below radius, each pair once """
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        if not self.n or not len(positions):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        if self.csr is None:
+            self.build_csr()
+        starts, ids = self.csr
+        rings = int(np.ceil(radius / self.cell_size))
+        steps = np.arange(-rings, rings+1)
+        offsets = np.stack(np.meshgrid(steps, steps, indexing="ij"), axis=-1).reshape(-1, 2)
+        ij = np.clip(np.floor((positions - self.origin) / self.cell_size), 0, self.shape - 1).astype(np.int64)
+        nb = ij[:, None, :] + offsets[None, :, :]
+        inside = np.all((nb >= 0) & (nb < self.shape), axis=-1)
+        keys = np.where(inside, nb[..., 0]*self.shape[1] + nb[..., 1], 0)
+        c = np.where(inside, starts[keys+1] - starts[keys], 0).ravel()
+        s = starts[keys].ravel()
+        agent = np.repeat(np.repeat(np.arange(len(positions)), len(offsets)), c)
+        obst = ids[np.repeat(s - (np.cumsum(c) - c), c) + np.arange(c.sum())]
+        pair_keys = np.unique(agent * self.n + obst)
+        agent, obst = np.divmod(pair_keys, self.n)
+        b = self.data[obst]
+        closest = np.clip(positions[agent], b[:, :2], b[:, 2:])
+        near = np.sum((closest - positions[agent])**2, axis=1) < radius**2
+        return agent[near], obst[near]
+
+class ObstacleField:
+    """ Vector field fn(points) -> (P, 2) sampled once at the nodes of a regular grid over a rectangle and read back
+        by bilinear interpolation, clamped to the rectangle. Used for the repulsion of static obstacles, whose
+        lookup then costs the same for any number of obstacles """
+    def __init__(self, x_min, y_min, x_max, y_max, cell_size, fn, max_nodes=MAX_NODES):
+        cell_size = max(cell_size, np.sqrt((x_max - x_min) * (y_max - y_min) / max_nodes))
+        self.origin = np.array([x_min, y_min], dtype=float)
+        self.cell_size = cell_size
+        self.shape = np.ceil((np.array([x_max, y_max]) - self.origin) / cell_size).astype(np.int64) + 1
+        xs, ys = (self.origin[k] + cell_size*np.arange(self.shape[k]) for k in range(2))
+        self.values = np.empty((*self.shape, 2))
+        rows = max(1, CHUNK_SIZE // (16*len(ys)))
+        for lo in range(0, len(xs), rows):
+            nodes = np.stack(np.meshgrid(xs[lo:lo+rows], ys, indexing="ij"), axis=-1)
+            self.values[lo:lo+rows] = fn(nodes.reshape(-1, 2)).reshape(nodes.shape)
+
+    def lookup(self, positions):
+        u = np.clip((positions - self.origin) / self.cell_size, 0, self.shape - 1)
+        i = np.minimum(u.astype(np.int64), self.shape - 2)
+        f = u - i
+        fx, fy = f[:, :1], f[:, 1:]
+        ny = self.shape[1]
+        corners = np.take(self.values.reshape(-1, 2), (i[:, 0]*ny + i[:, 1])[:, None] + [0, 1, ny, ny+1], axis=0)
+        low = corners[:, 0] + fy*(corners[:, 1] - corners[:, 0])
+        high = corners[:, 2] + fy*(corners[:, 3] - corners[:, 2])
+        return low + fx*(high - low)
+
+class PoissonGrid:
+    """ Background grid for minimum-distance sampling: cell side r/sqrt(2), so at most one point per cell """
+    def __init__(self, x_min, y_min, x_max, y_max, r):
+        self.r = r
+        self.cell_size = r / np.sqrt(2)
+        self.origin = np.array([x_min, y_min], dtype=float)
+        shape = np.floor((np.array([x_max, y_max]) - self.origin) / self.cell_size).astype(np.int64) + 1
+        self.cells = np.full(shape, -1, dtype=np.int64)
+        self.data = np.empty((64, 2))
+        self.n = 0
+
+    @property
+    def points(self):
+        return self.data[:self.n]
+
+    def cell_of(self, points):
+        ij = np.floor((points - self.origin) / self.cell_size).astype(np.int64)
+        return np.clip(ij, 0, np.array(self.cells.shape) - 1)
+
+    def far_enough(self, candidates):
+        """ True where a candidate is at least r away from every stored point """
+        candidates = np.asarray(candidates, dtype=float).reshape(-1, 2)
+        nb = self.cell_of(candidates)[:, None, :] + OFFSETS_5X5[None, :, :]
+        inside = np.all((nb >= 0) & (nb < self.cells.shape), axis=-1)
+        nb = np.where(inside[..., None], nb, 0)
+        idx = np.where(inside, self.cells[nb[..., 0], nb[..., 1]], -1)
+        d_sq = np.sum((self.data[np.maximum(idx, 0)] - candidates[:, None, :])**2, axis=-1)
+        return ~np.any((idx >= 0) & (d_sq < self.r**2), axis=1)
+
+    def insert(self, points):
+        """ Points must already be pairwise (and against stored points) at least r apart """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if self.n + len(points) > len(self.data):
+            new_data = np.empty((max(2*len(self.data), self.n + len(points)), 2))
+            new_data[:self.n] = self.points
+            self.data = new_data
+        ij = self.cell_of(points)
+        self.cells[ij[:, 0], ij[:, 1]] = np.arange(self.n, self.n + len(points))
+        self.data[self.n:self.n + len(points)] = points
+        self.n += len(points)
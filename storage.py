@@ -0,0 +1,155 @@
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+
+from classes import Map, Trajectory, StreamingTrajectory, STREAM_WINDOW, STREAM_CHUNK
+
+FORMAT_VERSION  = 1
+DTYPE           = "<f8"
+HEADER          = "header.json"
+MAP_KWARGS      = ("fixed_map_size", "map_walls", "n_agents", "dt", "x_min", "y_min", "x_max", "y_max")
+QUEUE_CHUNKS    = 8         # pending chunks before append() blocks, bounds memory if the disk falls behind
+
+# A run is a directory holding header.json, one raw little-endian float64 file per trajectory
+# field (<name>.f8, rows appended along time) and small .npy files for the static map data.
+
+def field_file(path, name):
+    return os.path.join(path, f"{name}.f8")
+
+def write_header(path, header):
+    tmp = os.path.join(path, HEADER + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(header, f, indent=1)
+    os.replace(tmp, os.path.join(path, HEADER))
+
+def read_header(path):
+    with open(os.path.join(path, HEADER)) as f:
+        return json.load(f)
+
+def map_header(map):
+    header = {"format": FORMAT_VERSION, "fields": {}}
+    header["map"] = {k: getattr(map, k) for k in MAP_KWARGS}
+    header["map"]["n_obstacles"] = map.n_obstacles_walls_excluded
+    header["map"]["seed"] = map.seed
+    header["len_obst"] = [float(map.len_x_obst), float(map.len_y_obst)]
+    header["obstacle_ids"] = [o_id if isinstance(o_id, str) else int(o_id) for o_id in map.obstacles["id"]]
+    return header
+
+def save_static(map, path):
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "obstacle_bounds.npy"), map.obstacle_bounds)
+    np.save(os.path.join(path, "init_positions.npy"), map.init_positions_array)
+    np.save(os.path.join(path, "agent_ids.npy"), map.agents["id"])
+    np.save(os.path.join(path, "groups.npy"), map.agents["group"])
+    np.save(os.path.join(path, "radii.npy"), map.agents["r"])
+
+def save_map(map, path):
+    """ Write obstacles, groups, init positions and every per-step array of a finished run to directory path """
+    traj = map.trajectory
+    if isinstance(traj, StreamingTrajectory):
+        raise ValueError("A streamed map only holds its last steps in memory; its full run is in the directory "
+                         "given to start_stream, load that with load_map instead of saving the map")
+    save_static(map, path)
+    header = map_header(map)
+    for name in traj.data:
+        values = np.ascontiguousarray(traj[name], dtype=DTYPE)
+        values.tofile(field_file(path, name))
+        header["fields"][name] = {"shape": list(values.shape[1:]), "length": len(values)}
+    if traj.start:      # history restarted from a Map.checkpoint
+        header["start"] = traj.start
+        header["first"] = {name: np.asarray(row).tolist() for name, row in traj.first.items()}
+    write_header(path, header)
+
+def load_map(path, mmap=True):
+    """ Rebuild a Map from save_map output. With mmap the per-step arrays stay on disk as read-only
+        np.memmap views, so plot_map/animate_map can replay runs larger than RAM """
+    header = read_header(path)
+    kwargs = dict(header["map"])
+    map = Map(**kwargs)
+    map.len_x_obst, map.len_y_obst = header["len_obst"]
+    load = lambda name: np.load(os.path.join(path, f"{name}.npy"))
+
+    bounds = load("obstacle_bounds")
+    map.obstacles.extend(len(bounds), id=np.array(header["obstacle_ids"], dtype=object), bounds=bounds.reshape(-1, 4))
+    map.build_obstacle_index()
+
+    arrays = {}
+    for name, field in header["fields"].items():
+        shape = (field["length"], *field["shape"])
+        if mmap:
+            arrays[name] = np.memmap(field_file(path, name), dtype=DTYPE, mode="r", shape=shape)
+        else:
+            arrays[name] = np.fromfile(field_file(path, name), dtype=DTYPE).reshape(shape)
+    map.init_positions_array = load("init_positions")
+    ids = load("agent_ids")
+    map.agents.extend(len(ids), id=ids, group=load("groups"), r=load("radii"))
+    first = {name: np.array(row) for name, row in header.get("first", {}).items()}
+    map.attach_trajectory(Trajectory.from_arrays(arrays, start=header.get("start", 0), first=first))
+    return map
+
+class StreamWriter:
+    """ Appends trajectory chunks to a run directory from a background thread. The header is rewritten
+        after every chunk, so the directory can be loaded with load_map while the run is still going """
+    def __init__(self, map, path):
+        save_static(map, path)
+        self.path = path
+        self.header = map_header(map)
+        self.files = {}
+        self.error = None
+        self.queue = queue.Queue(maxsize=QUEUE_CHUNKS)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __call__(self, name, rows):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((name, rows))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            name, rows = item
+            try:
+                if name not in self.files:
+                    self.files[name] = open(field_file(self.path, name), "wb")
+                    self.header["fields"][name] = {"shape": list(rows.shape[1:]), "length": 0}
+                np.ascontiguousarray(rows, dtype=DTYPE).tofile(self.files[name])
+                self.files[name].flush()
+                self.header["fields"][name]["length"] += len(rows)
+                write_header(self.path, self.header)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        for f in self.files.values():
+            f.close()
+        if self.error is not None:
+            raise self.error
+
+def start_stream(map, path, window=STREAM_WINDOW, flush_every=STREAM_CHUNK):
+    """ Switch map to a StreamingTrajectory writing to directory path; the history so far is written first """
+    writer = StreamWriter(map, path)
+    old = map.trajectory
+    traj = StreamingTrajectory(map.init_positions_array, writer, window, flush_every)
+    for name in old.data:
+        for row in old[name][traj.lengths.get(name, 0):]:
+            traj.append(name, row)
+    map.attach_trajectory(traj)
+    return writer
+
+def stop_stream(map):
+    """ Flush the remaining rows and wait for the writer; the in-memory window stays attached to map,
+        detached from the writer, so that Map.restore can replace it """
+    traj = map.trajectory
+    traj.flush()
+    traj.sink.close()
+    traj.sink = None
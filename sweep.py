@@ -0,0 +1,147 @@
+import argparse
+import ast
+import csv
+import hashlib
+import itertools
+import json
+import os
+import time
+from concurrent.futures import as_completed
+
+import numpy as np
+
+from classes import Map
+from collisions import EventLog
+from initialize_map import init_map
+from pools import process_pool
+from velocity_control import append_vel_pos
+
+GAINS   = ("v_max", "r_rep", "r_att", "k_rep", "k_att", "k_target")
+METRICS = ("min_agent_dist", "obstacle_collisions", "separation_violations", "max_separation_depth",
+           "max_collision_depth", "violation_step_rate", "com_error_mean", "com_error_max", "wall_time")
+
+def grid(**axes):
+    """ All combinations of the given value lists, e.g. grid(n_agents=[10, 20], k_rep=[4.0, 8.0]) """
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*axes.values())]
+
+def random_sample(n, seed=0, **ranges):
+    """ n random parameter sets; a (low, high) tuple is sampled uniformly, a list is sampled from """
+    rng = np.random.default_rng(seed)
+    runs = [{} for _ in range(n)]
+    for name, spec in ranges.items():
+        if isinstance(spec, tuple):
+            low, high = spec
+            values = rng.integers(low, high+1, n) if isinstance(low, int) else rng.uniform(low, high, n)
+        else:
+            values = [spec[k] for k in rng.integers(0, len(spec), n)]
+        for run, value in zip(runs, values):
+            run[name] = value.item() if isinstance(value, np.generic) else value
+    return runs
+
+def params_hash(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+
+def run_id(params, n_steps, seed):
+    """ Also covers the run length and the base seed, so a sweep with other --steps or --seed reruns it """
+    return params_hash({"params": params, "n_steps": n_steps, "seed": seed})
+
+def run_seed(seed, params):
+    """ Depends only on the base seed and the parameters, so reruns and resumed sweeps match """
+    return int(np.random.SeedSequence([seed, int(params_hash(params), 16)]).generate_state(1)[0])
+
+def run_one(params, n_steps, seed):
+    gains = {k: v for k, v in params.items() if k in GAINS}
+    map = Map(seed=seed, **{k: v for k, v in params.items() if k not in GAINS})
+    t0 = time.perf_counter()
+    init_map(map)
+    map.events = EventLog()
+    for _ in range(n_steps):
+        append_vel_pos(map, **gains)
+    metrics = compute_metrics(map)
+    metrics["wall_time"] = time.perf_counter() - t0
+    return metrics
+
+def compute_metrics(map):
+    """ Ranking metrics; the spacing and collision ones come from map.events, which run_one attaches so that
+        no per-step history is scanned. A map stepped without one has its recorded positions checked instead """
+    events, com = map.events, map.trajectory["C_O_M"]
+    if events is None:
+        events, positions = EventLog(), map.trajectory["p"]
+        for t in range(1, len(positions)):
+            events.check(map, positions[t], t)
+    times = np.arange(len(com)) * map.dt
+    targets = map.targets.evaluate(times, map.all_groups, com[0]) if len(com) else com
+    errors = np.linalg.norm(com - targets, axis=-1)
+    return {**events.summary(),
+            "com_error_mean": errors.mean() if errors.size else 0.0,
+            "com_error_max": errors.max() if errors.size else 0.0}
+
+def finished_runs(results_file):
+    """ run_ids with a row that has no error; failed runs, e.g. all pending ones after a worker crash, are retried """
+    if not os.path.exists(results_file):
+        return set()
+    with open(results_file, newline="") as f:
+        return {row["run_id"] for row in csv.DictReader(f) if not row.get("error")}
+
+def sweep(runs, n_steps, results_file, seed=0, max_workers=None):
+    """ Run every parameter set in runs on a process pool, appending one CSV row per finished run.
+        Runs that already succeeded in results_file are skipped, so an interrupted sweep can be restarted
+        as is; a retried run gets a new row after its failed one. The pool workers import the calling
+        script, so call it under `if __name__ == "__main__":` """
+    done = finished_runs(results_file)
+    todo = [params for params in runs if run_id(params, n_steps, seed) not in done]
+    print(f"{len(runs)} runs, {len(runs)-len(todo)} already done")
+    if not todo:
+        return
+    param_names = sorted({k for params in runs for k in params})
+    fieldnames = ["run_id", "seed"] + param_names + list(METRICS) + ["error"]
+    new_file = not os.path.exists(results_file) or not os.path.getsize(results_file)
+    if not new_file:
+        with open(results_file, newline="") as f:
+            fieldnames = next(csv.reader(f))
+    with open(results_file, "a", newline="") as f, process_pool(max_workers) as pool:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+        if new_file:
+            writer.writeheader()
+        futures = {}
+        for params in todo:
+            s = run_seed(seed, params)
+            futures[pool.submit(run_one, params, n_steps, s)] = (params, s)
+        for k, future in enumerate(as_completed(futures)):
+            params, s = futures[future]
+            row = {"run_id": run_id(params, n_steps, seed), "seed": s, **params}
+            try:
+                row.update(future.result())
+            except Exception as e:
+                row["error"] = repr(e)
+            writer.writerow(row)
+            f.flush()
+            print(f"{k+1}/{len(todo)} {row['run_id']} {row.get('error') or ''}")
+
+def parse_axis(s):
+    """ 'k_rep=4,8' -> ('k_rep', [4, 8]) """
+    name, values = s.split("=", 1)
+    values = ast.literal_eval(f"[{values}]")
+    return name, values
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parameter sweep over Map settings and controller gains")
+    parser.add_argument("axes", nargs="+", help="name=v1,v2,... for each swept parameter")
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--out", default="sweep.csv")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--samples", type=int, default=0,
+                        help="draw this many random runs instead of the full grid (two values = range)")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args(argv)
+    axes = dict(parse_axis(s) for s in args.axes)
+    if args.samples:
+        ranges = {k: tuple(v) if len(v) == 2 else v for k, v in axes.items()}
+        runs = random_sample(args.samples, args.seed, **ranges)
+    else:
+        runs = grid(**axes)
+    sweep(runs, args.steps, args.out, seed=args.seed, max_workers=args.workers)
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,109 @@
 import numpy as np
 
+TARGET_BLOCK    = 4096      # steps of targets precomputed at once while stepping
+TARGET_VELOCITY = (0.1, 0.1)
+
 def target_point(init_pos, t):
     target = init_pos + 0.1 * t * np.array([1.0,1.0])
-    return np.array(target)
\ No newline at end of file
+    return np.array(target)
+
+# Paths map a (T,) vector of times and the (G, 2) initial centers of mass of the groups following them to
+# (T, G, 2) targets. Relative paths are offset by that origin, absolute ones ignore it.
+
+class Line:
+    """ origin + t*velocity, the default target of every group """
+    def __init__(self, velocity=TARGET_VELOCITY):
+        self.velocity = np.asarray(velocity, dtype=float)
+
+    def __call__(self, t, origin):
+        return origin + t[:, None, None] * self.velocity
+
+class Waypoints:
+    """ Piecewise linear through points (K, 2) reached at the increasing times (K,), holding the last point
+        afterwards, or starting over with loop=True """
+    def __init__(self, points, times, relative=False, loop=False):
+        self.points, self.times = np.asarray(points, dtype=float), np.asarray(times, dtype=float)
+        self.relative, self.loop = relative, loop
+
+    def local_time(self, t):
+        if self.loop:
+            return self.times[0] + np.mod(t - self.times[0], self.times[-1] - self.times[0])
+        return t
+
+    def positions(self, t):
+        return np.stack([np.interp(t, self.times, self.points[:, k]) for k in range(2)], axis=-1)
+
+    def __call__(self, t, origin):
+        p = self.positions(self.local_time(t))[:, None, :]
+        return p + origin if self.relative else np.broadcast_to(p, (len(t), len(origin), 2))
+
+class Spline(Waypoints):
+    """ Cubic Hermite spline through the waypoints with finite difference tangents, so the target velocity
+        is continuous instead of jumping at every waypoint """
+    def __init__(self, points, times, relative=False, loop=False):
+        super().__init__(points, times, relative, loop)
+        self.tangents = np.gradient(self.points, self.times, axis=0) if len(self.times) > 1 else np.zeros_like(self.points)
+
+    def positions(self, t):
+        if len(self.times) < 2:
+            return np.broadcast_to(self.points[0], (len(t), 2))
+        t = np.clip(t, self.times[0], self.times[-1])
+        k = np.clip(np.searchsorted(self.times, t, side="right") - 1, 0, len(self.times) - 2)
+        h = (self.times[k+1] - self.times[k])[:, None]
+        s = (t - self.times[k])[:, None] / h
+        h00, h10, h01, h11 = 2*s**3 - 3*s**2 + 1, s**3 - 2*s**2 + s, -2*s**3 + 3*s**2, s**3 - s**2
+        return (h00*self.points[k] + h10*h*self.tangents[k] + h01*self.points[k+1] + h11*h*self.tangents[k+1])
+
+class Path:
+    """ Analytic path fn(t) -> (T, 2), vectorized over t """
+    def __init__(self, fn, relative=True):
+        self.fn, self.relative = fn, relative
+
+    def __call__(self, t, origin):
+        p = np.asarray(self.fn(t), dtype=float)[:, None, :]
+        return p + origin if self.relative else np.broadcast_to(p, (len(t), len(origin), 2))
+
+class Targets:
+    """ Target path of every group (groups without one follow default), evaluated for whole blocks of steps
+        so that stepping only looks rows up in a (T, G, 2) table """
+    def __init__(self, paths=None, default=None, block=TARGET_BLOCK):
+        self.paths = dict(paths or {})
+        self.default = default if default is not None else Line()
+        self.block = block
+        self.table, self.start, self.key = None, 0, None
+
+    def set_path(self, group, path):
+        self.paths[group] = path
+        self.table = None
+
+    def evaluate(self, times, groups, origins):
+        """ (T, G, 2) targets at times (T,) of groups (G,) starting from their initial centers of mass origins """
+        times = np.atleast_1d(np.asarray(times, dtype=float))
+        origins = np.asarray(origins, dtype=float).reshape(-1, 2)
+        targets = np.empty((len(times), len(groups), 2))
+        paths = [self.paths.get(g, self.default) for g in np.asarray(groups).tolist()]
+        for path in {id(p): p for p in paths}.values():     # one call per distinct path, not per group
+            idx = [k for k, p in enumerate(paths) if p is path]
+            targets[:, idx] = path(times, origins[idx])
+        return targets
+
+    def precompute(self, start, n_steps, dt, groups, origins):
+        """ Table of steps start .. start+n_steps-1, e.g. a whole run up front """
+        self.table = self.evaluate((start + np.arange(n_steps)) * dt, groups, origins)
+        self.start = start
+        self.key = (dt, np.array(groups), np.array(origins, dtype=float))
+        return self.table
+
+    def lookup(self, t_idx, dt, groups, origins):
+        """ (G, 2) targets of step t_idx; a new block is computed when t_idx leaves the table or the
+            groups, their origins or dt changed """
+        k = t_idx - self.start
+        if self.table is None or not 0 <= k < len(self.table) or not self.matches(dt, groups, origins):
+            self.precompute(t_idx, self.block, dt, groups, origins)
+            k = 0
+        return self.table[k]
+
+    def matches(self, dt, groups, origins):
+        key_dt, key_groups, key_origins = self.key
+        return (dt == key_dt and np.array_equal(groups, key_groups)
+                and np.array_equal(np.asarray(origins).reshape(-1, 2), key_origins))
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+from classes import Map
+from collisions import EventLog
+from initialize_map import init_map
+from storage import load_map, save_map, start_stream, stop_stream
+from velocity_control import append_vel_pos
+
+N_STEPS = 40
+T = 20
+FIELDS = ("p", "v", "p_target", "v_target", "v_field", "v_des", "C_O_M")
+
+def make_map():
+    """ Walled map with obstacles and three groups """
+    map = Map(n_agents=30, n_obstacles=4, len_x=6, len_y=6, map_walls=True, seed=1)
+    init_map(map)
+    map.agents.set("group", slice(None), np.arange(len(map.agents)) % 3)
+    return map
+
+def run(map, n_steps=N_STEPS, **gains):
+    for _ in range(n_steps):
+        append_vel_pos(map, **gains)
+    return map
+
+def assert_same_steps(traj, reference):
+    assert traj.n_steps == reference.n_steps
+    for name in FIELDS:
+        np.testing.assert_array_equal(traj[name][-(N_STEPS - T):], reference[name][-(N_STEPS - T):], err_msg=name)
+
+def test_restore_replays_the_same_steps():
+    reference = run(make_map()).trajectory
+    map = run(make_map())
+    map.restore(map.checkpoint(T))
+    assert map.trajectory.n_steps == T
+    assert_same_steps(run(map, N_STEPS - T).trajectory, reference)
+
+    # a fresh map restarts its history at step T and still follows the same targets
+    restarted = make_map()
+    restarted.restore(map.checkpoint(T))
+    assert restarted.trajectory.start == T
+    assert_same_steps(run(restarted, N_STEPS - T).trajectory, reference)
+
+def test_restore_loaded_map(tmp_path):
+    reference = run(make_map())
+    save_map(reference, tmp_path)
+    map = load_map(tmp_path, mmap=True)
+    map.restore(map.checkpoint(T))
+    assert_same_steps(run(map, N_STEPS - T).trajectory, reference.trajectory)
+    np.testing.assert_array_equal(np.memmap(tmp_path / "p.f8", dtype="<f8", mode="r").reshape(-1, 30, 2),
+                                  reference.trajectory["p"])   # the files on disk are left alone
+
+def test_restore_rewinds_events():
+    crowded = {"k_rep": 1.0, "k_att": 2.0}      # weak repulsion, so agents crowd and collide
+    def logged_run(n_steps):
+        map = make_map()
+        map.events = EventLog()
+        return run(map, n_steps, **crowded)
+    reference, until_t = logged_run(N_STEPS).events, logged_run(T).events
+    map = logged_run(N_STEPS)
+    map.restore(map.checkpoint(T))
+    assert map.events.n_steps == until_t.n_steps == T
+    assert map.events.min_agent_dist == until_t.min_agent_dist > reference.min_agent_dist
+    np.testing.assert_array_equal(map.events.events, until_t.events)
+    run(map, N_STEPS - T, **crowded)
+    np.testing.assert_array_equal(map.events.events, reference.events)
+    assert map.events.summary() == reference.summary()
+
+def test_restore_streamed_map(tmp_path):
+    reference = run(make_map()).trajectory
+    map = make_map()
+    start_stream(map, tmp_path, window=8, flush_every=4)
+    run(map)
+    blob = map.checkpoint()
+    with pytest.raises(ValueError, match="stop_stream"):
+        map.restore(blob)
+    assert map.trajectory.n_steps == N_STEPS
+    stop_stream(map)
+    map.restore(map.checkpoint(N_STEPS - 4))
+    run(map, 4)
+    for name in FIELDS:
+        np.testing.assert_array_equal(map.trajectory[name][-4:], reference[name][-4:], err_msg=name)
@@ -0,0 +1,27 @@
+import numpy as np
+
+from classes import Map
+from collisions import AGENT, OBSTACLE, EventLog, detect_trajectory
+from initialize_map import init_map
+from velocity_control import append_vel_pos
+
+N_STEPS = 40
+
+def sort_events(events):
+    return events[np.lexsort((events["j"], events["i"], events["kind"], events["t"]))]
+
+def test_event_log_matches_detect_trajectory():
+    map = Map(n_agents=40, n_obstacles=4, len_x=5, len_y=5, map_walls=True, seed=4)
+    init_map(map)
+    map.events = EventLog()
+    for _ in range(N_STEPS):
+        append_vel_pos(map, k_rep=1.0, k_att=2.0)     # weak repulsion, so agents crowd and collide
+    logged, replayed = sort_events(map.events.events), sort_events(detect_trajectory(map, start=1))
+    assert map.events.n_steps == N_STEPS
+    assert np.any(logged["kind"] == AGENT) and np.any(logged["kind"] == OBSTACLE)
+    np.testing.assert_array_equal(logged, replayed)
+
+    positions = map.trajectory["p"][1:]
+    dists = np.linalg.norm(positions[:, :, None] - positions[:, None, :], axis=-1)
+    dists[:, np.arange(len(map.agents)), np.arange(len(map.agents))] = np.inf
+    assert map.events.min_agent_dist == dists.min()
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from classes import Map
+from ensemble import Ensemble, FIELDS
+from initialize_map import init_map
+from velocity_control import append_vel_pos, numba_kernels
+
+N_STEPS = 30
+START = 12
+
+def make_map(seed, n_groups):
+    """ Walled map with obstacles and n_groups groups """
+    map = Map(n_agents=20, n_obstacles=3, len_x=5, len_y=5, map_walls=True, seed=seed)
+    init_map(map)
+    map.agents.set("group", slice(None), np.arange(len(map.agents)) % n_groups)
+    return map
+
+def restarted_maps():
+    """ Maps whose history starts at step START, restored from checkpoints of other runs """
+    maps = []
+    for seed, n_groups in ((1, 3), (2, 2)):
+        source = make_map(seed, n_groups)
+        for _ in range(START):
+            append_vel_pos(source)
+        map = make_map(seed, n_groups)
+        map.restore(source.checkpoint(START))
+        maps.append(map)
+    return maps
+
+@pytest.mark.parametrize("backend", ["numpy", pytest.param("numba", marks=pytest.mark.skipif(
+    numba_kernels is None, reason="numba is not installed"))])
+def test_ensemble_matches_sequential(backend):
+    sequential = restarted_maps()
+    for map in sequential:
+        assert map.trajectory.start == START
+        for _ in range(N_STEPS):
+            append_vel_pos(map, cell_list=False, backend=backend)
+    ensemble = Ensemble(restarted_maps())
+    ensemble.step(N_STEPS, backend=backend)
+    for map, reference in zip(ensemble.to_maps(), sequential):
+        traj = map.trajectory
+        assert traj.start == START and traj.n_steps == reference.trajectory.n_steps == START + N_STEPS
+        np.testing.assert_array_equal(traj.first_row("C_O_M"), reference.trajectory.first_row("C_O_M"))
+        for name in FIELDS:
+            np.testing.assert_allclose(traj[name], reference.trajectory[name], rtol=0, atol=1e-12, err_msg=name)
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from classes import Map
+from initialize_map import init_map
+from velocity_control import append_vel_pos, numba_kernels
+
+N_STEPS = 40
+FIELDS = ("p", "v", "p_target", "v_target", "v_field", "v_des", "C_O_M")
+
+def make_map():
+    """ Walled map with obstacles and three groups """
+    map = Map(n_agents=30, n_obstacles=4, len_x=6, len_y=6, map_walls=True, seed=1)
+    init_map(map)
+    map.agents.set("group", slice(None), np.arange(len(map.agents)) % 3)
+    return map
+
+def run(**kwargs):
+    map = make_map()
+    for _ in range(N_STEPS):
+        append_vel_pos(map, **kwargs)
+    return map.trajectory
+
+@pytest.mark.parametrize("backend", ["numpy", pytest.param("numba", marks=pytest.mark.skipif(
+    numba_kernels is None, reason="numba is not installed"))])
+def test_dense_matches_reference(backend):
+    reference = run(vectorized=False)
+    dense = run(cell_list=False, backend=backend)
+    assert dense.n_steps == reference.n_steps == N_STEPS
+    for name in FIELDS:
+        np.testing.assert_allclose(dense[name], reference[name], rtol=0, atol=1e-12, err_msg=name)
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from classes import Map
+from initialize_map import init_map
+from storage import load_map, save_map, start_stream, stop_stream
+from velocity_control import append_vel_pos
+
+N_STEPS = 40
+
+def make_map():
+    """ Walled map with obstacles and three groups """
+    map = Map(n_agents=30, n_obstacles=4, len_x=6, len_y=6, map_walls=True, seed=1)
+    init_map(map)
+    map.agents.set("group", slice(None), np.arange(len(map.agents)) % 3)
+    return map
+
+def run(map, n_steps=N_STEPS):
+    for _ in range(n_steps):
+        append_vel_pos(map)
+    return map
+
+def assert_same_run(loaded, map):
+    assert loaded.trajectory.n_steps == map.trajectory.n_steps
+    assert loaded.trajectory.start == map.trajectory.start
+    assert set(loaded.trajectory.data) == set(map.trajectory.data)
+    for name in map.trajectory.data:
+        np.testing.assert_array_equal(loaded.trajectory[name], map.trajectory[name], err_msg=name)
+    for name, row in map.trajectory.first.items():
+        np.testing.assert_array_equal(loaded.trajectory.first_row(name), row, err_msg=name)
+    np.testing.assert_array_equal(loaded.obstacle_bounds, map.obstacle_bounds)
+    np.testing.assert_array_equal(loaded.init_positions_array, map.init_positions_array)
+    for name in ("id", "group", "r"):
+        np.testing.assert_array_equal(loaded.agents[name], map.agents[name], err_msg=name)
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_round_trip_is_bit_exact(tmp_path, mmap):
+    map = run(make_map())
+    save_map(map, tmp_path)
+    assert_same_run(load_map(tmp_path, mmap=mmap), map)
+
+def test_round_trip_keeps_restarted_history(tmp_path):
+    blob = run(make_map()).checkpoint(N_STEPS // 2)
+    map = make_map()
+    map.restore(blob)
+    run(map, 10)
+    assert map.trajectory.start == N_STEPS // 2
+    save_map(map, tmp_path)
+    assert_same_run(load_map(tmp_path), map)
+
+def test_streamed_map_is_not_saved(tmp_path):
+    map = make_map()
+    start_stream(map, tmp_path / "stream", window=8, flush_every=4)
+    run(map)
+    with pytest.raises(ValueError, match="start_stream"):
+        save_map(map, tmp_path / "saved")
+    stop_stream(map)
+    with pytest.raises(ValueError, match="start_stream"):
+        save_map(map, tmp_path / "saved")
+    np.testing.assert_array_equal(load_map(tmp_path / "stream").trajectory["p"], run(make_map()).trajectory["p"])
@@ -0,0 +1,38 @@
+import csv
+
+from sweep import finished_runs, run_id, sweep
+
+N_STEPS = 10
+RUNS = [{"n_agents": 8, "n_obstacles": 2, "len_x": 4, "len_y": 4, "k_rep": k_rep} for k_rep in (4.0, 8.0)]
+
+def read_rows(path):
+    with open(path, newline="") as f:
+        return list(csv.DictReader(f))
+
+def test_resume_skips_finished_and_retries_failed(tmp_path):
+    results = tmp_path / "sweep.csv"
+    sweep(RUNS, N_STEPS, str(results), seed=3, max_workers=1)
+    rows = read_rows(results)
+    assert len(rows) == 2 and not any(row["error"] for row in rows)
+
+    # mark the second run as crashed, the way a dead worker leaves it
+    failed = run_id(RUNS[1], N_STEPS, 3)
+    for row in rows:
+        if row["run_id"] == failed:
+            row.update(min_agent_dist="", error="BrokenProcessPool()")
+    with open(results, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    assert finished_runs(str(results)) == {run_id(RUNS[0], N_STEPS, 3)}
+
+    sweep(RUNS, N_STEPS, str(results), seed=3, max_workers=1)
+    resumed = read_rows(results)
+    assert resumed[:2] == rows
+    assert len(resumed) == 3 and resumed[2]["run_id"] == failed and not resumed[2]["error"]
+    assert finished_runs(str(results)) == {run_id(params, N_STEPS, 3) for params in RUNS}
+
+    # a finished sweep does nothing, while another run length counts as new runs
+    sweep(RUNS, N_STEPS, str(results), seed=3, max_workers=1)
+    assert len(read_rows(results)) == 3
+    assert not finished_runs(str(results)) & {run_id(params, N_STEPS+1, 3) for params in RUNS}
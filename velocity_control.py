@@ -1,6 +1,12 @@
 import numpy as np
 
-from target_points import target_point
+from instrumentation import NULL_STATS
+from spatial import CellList, ObstacleField
+
+try:
+    import numba_kernels
+except ImportError:     # numba is optional, the NumPy kernels below are always available
+    numba_kernels = None
 
 V_MAX       = 3.0
 R_REP       = 0.5
@@ -9,38 +15,245 @@ K_REP       = 8.0
 K_ATT       = 0.2
 K_TARGET    = 1.5
 
-def append_vel_pos(map, t=-1, v_max=V_MAX, r_rep=R_REP, r_att=R_ATT, k_rep=K_REP, k_att=K_ATT, k_target=K_TARGET):
-    all_obstacles, groups, dt = map.all_obstacles, map.all_groups, map.dt
-    t_idx = t if t >= 0 else len(map.all_agents[0].p[0])-1
-    time = t_idx * map.dt
-    diffs, dists, center_of_mass = compute_diffs_dists_com(map.all_agents, groups, t_idx)
-    map.C_O_M = np.append(map.C_O_M,np.array([center_of_mass]),axis=0) if map.C_O_M.size else np.array([center_of_mass])
-    target = target_point(map.C_O_M[0], time)
-    for i, a in enumerate(map.all_agents):
-        g_idx = np.where(groups == a.group)
-        c_o_m = center_of_mass[g_idx]
-        v_field, v_target, v_des = compute_v_des(i, t_idx, a, all_obstacles, diffs, dists, target, c_o_m,
-                                                 v_max, r_rep, r_att, k_rep, k_att, k_target)
-        v_field, v_target, v_des = v_field.reshape(2,1), v_target.reshape(2,1), v_des.reshape(2,1)
-        p = (a.p[:,t] + a.v[:,t]*dt).reshape(2,1)
-        p_target = target.reshape(2,1)
-        a.p = np.hstack((a.p, p))
-        a.p_target = np.hstack((a.p_target, p_target)) if a.p_target.size else p_target
-        a.v = np.hstack((a.v, v_des))
-        a.v_target = np.hstack((a.v_target, v_target)) if a.v_target.size else v_target
-        a.v_field = np.hstack((a.v_field, v_field)) if a.v_field.size else v_field
-        a.v_des = np.hstack((a.v_des, v_des)) if a.v_des.size else v_des
-
-def compute_diffs_dists_com(agents, groups, t):
-    positions = np.array([[a.p[0][t],a.p[1][t]] for a in agents])
+# From CELL_LIST_MIN_AGENTS agents on, cell_list=None switches to the cell-list field, which is NOT exact: the
+# attraction beyond the 3x3 cell block is approximated from cell centres of mass (CellList.far_unit_sums,
+# a few % of that term). Forced onto 40 agents it moves positions by ~1e-2 within 40 steps. cell_list=False
+# keeps the exact dense field at any size
+CELL_LIST_MIN_AGENTS = 1000     # above this the cell-list field replaces the dense N x N one
+CELL_LIST_MIN_AGENTS_COMPILED = 50000   # same crossover for the numba kernel
+BACKEND     = "numba" if numba_kernels is not None else "numpy"
+def append_vel_pos(map, t=-1, v_max=V_MAX, r_rep=R_REP, r_att=R_ATT, k_rep=K_REP, k_att=K_ATT, k_target=K_TARGET,
+                   vectorized=True, cell_list=None, backend=None):
+    t_idx = t if t >= 0 else map.trajectory.n_steps
+    step = compute_step(map, t_idx, v_max, r_rep, r_att, k_rep, k_att, k_target, vectorized, cell_list, backend)
+    p = integrate(map, t_idx)
+    record_step(map, p, *step)
+
+def compute_step(map, t_idx, v_max=V_MAX, r_rep=R_REP, r_att=R_ATT, k_rep=K_REP, k_att=K_ATT, k_target=K_TARGET,
+                 vectorized=True, cell_list=None, backend=None, positions=None, time=None):
+    """ backend "numba" runs the dense vectorized field as one compiled kernel, "numpy" never does;
+        None picks numba when it is installed. positions and time replace those of step t_idx, e.g. for the
+        intermediate stages of acceleration_control's integrators (vectorized only) """
+    backend = backend or BACKEND
+    if backend == "numba" and numba_kernels is None:
+        raise ValueError("backend='numba' needs numba installed")
+    if positions is not None and not vectorized:
+        raise ValueError("positions can only be given to the vectorized step")
+    all_obstacles, traj = map.all_obstacles, map.trajectory
+    stats = map.stats.active()
+    stats.start()
+    groups, group_idx, counts = map.group_index()
+    stats.lap("groups")
+    t_row = traj.local("p", t_idx)     # differs from t_idx when only a window of the history is kept
+    positions = traj["p"][t_row] if positions is None else positions
+    if cell_list is None:
+        cell_list = traj.n_agents >= (CELL_LIST_MIN_AGENTS_COMPILED if backend == "numba" else CELL_LIST_MIN_AGENTS)
+    compiled = vectorized and not cell_list and backend == "numba"
+    if vectorized and (cell_list or compiled):
+        center_of_mass = compute_com(positions, group_idx, counts)
+    elif vectorized:
+        diffs, dists = compute_diffs_dists(positions)
+        center_of_mass = compute_com(positions, group_idx, counts)
+    else:
+        diffs, dists, center_of_mass = compute_diffs_dists_com(map.all_agents, group_idx, counts, t_row)
+    stats.lap("distances")
+    origins = traj.first_row("C_O_M", center_of_mass)
+    if time is None:
+        target = map.targets.lookup(t_idx, map.dt, groups, origins)
+    else:
+        target = map.targets.evaluate(time, groups, origins)[0]
+    stats.lap("target")
+    if vectorized:
+        obstacle_index = map.obstacle_index if map.obstacle_index is not None else map.build_obstacle_index()
+        obstacle_field = get_obstacle_field(map, r_rep)
+        if cell_list:
+            v_fields = compute_v_field_cells(positions, obstacle_index, r_rep, k_rep, r_att, k_att, stats, obstacle_field)
+        elif compiled:
+            v_fields = numba_kernels.compute_v_field(positions, obstacle_index, r_rep, k_rep, r_att, k_att, stats,
+                                                     obstacle_field)
+        else:
+            v_fields = compute_v_field_all(positions, obstacle_index, diffs, dists, r_rep, k_rep, r_att, k_att, stats,
+                                           obstacle_field)
+        v_targets, v_dess = compute_v_des_all(v_fields, group_idx, target, center_of_mass, v_max, k_target)
+        p_targets = target[group_idx]
+        stats.lap("v_des")
+    else:
+        p_targets, v_fields, v_targets, v_dess = (np.empty((traj.n_agents, 2)) for _ in range(4))
+        for i, a in enumerate(map.all_agents):
+            g_idx = group_idx[i]
+            c_o_m = center_of_mass[g_idx]
+            v_field, v_target, v_des = compute_v_des(i, t_row, a, all_obstacles, diffs, dists, target[g_idx], c_o_m,
+                                                     v_max, r_rep, r_att, k_rep, k_att, k_target)
+            p_targets[i], v_fields[i], v_targets[i], v_dess[i] = target[g_idx], v_field, v_target, v_des
+            stats.lap("field")
+        stats.count("pairs", traj.n_agents*(traj.n_agents-1))
+        stats.count("obstacle_tests", traj.n_agents*len(all_obstacles))
+    if stats.enabled:
+        stats.count("clipped", np.count_nonzero(np.linalg.norm(v_fields + v_targets, axis=1) > v_max))
+    return center_of_mass, p_targets, v_fields, v_targets, v_dess
+
+def integrate(map, t_idx):
+    traj = map.trajectory
+    p = traj.row("p", t_idx) + traj.row("v", t_idx)*map.dt
+    map.stats.active().lap("integration")
+    return p
+
+def record_step(map, p, center_of_mass, p_targets, v_fields, v_targets, v_dess, v=None, a=None):
+    """ v defaults to v_des, as the velocity controller tracks it exactly; a is only recorded when given """
+    traj = map.trajectory
+    traj.append("C_O_M", center_of_mass)
+    traj.append("p", p)
+    traj.append("p_target", p_targets)
+    traj.append("v", v_dess if v is None else v)
+    traj.append("v_target", v_targets)
+    traj.append("v_field", v_fields)
+    traj.append("v_des", v_dess)
+    if a is not None:
+        traj.append("a", a)
+    stats = map.stats.active()
+    stats.lap("history")
+    if map.events is not None:
+        map.events.check(map, p, traj.n_steps)
+        stats.lap("collisions")
+    stats.count("steps")
+
+def get_positions(agents, t):
+    traj = agents[0].traj if len(agents) else None
+    if traj is not None:
+        return traj["p"][t]
+    return np.array([[a.p[0][t],a.p[1][t]] for a in agents]).reshape(-1, 2)
+
+def compute_diffs_dists_com(agents, group_idx, counts, t):
+    positions = get_positions(agents, t)
+    diffs, dists = compute_diffs_dists(positions)
+    center_of_mass = compute_com(positions, group_idx, counts)
+    return diffs, dists, center_of_mass
+
+def compute_diffs_dists(positions):
     diffs = positions[None, :, :] - positions[:, None, :]   # (N, N, 2) diffs[i,j] = positions[j] - positions[i]
     dists = np.linalg.norm(diffs, axis=2)                   # (N, N)    dists[i,j] = dists[j,i],  dists[i,i] = 0
-    center_of_mass = []
-    for g in groups:
-        agents_idx = [i for i in range(len(positions)) if agents[i].group == g]
-        c_o_m_g = np.mean(positions[agents_idx], axis=0)
-        center_of_mass.append(c_o_m_g)
-    return diffs, dists, np.array(center_of_mass)
+    return diffs, dists
+
+def compute_com(positions, group_idx, counts):
+    """ Mean position of every group in a single pass, see Map.group_index """
+    return scatter_sum(group_idx, positions, len(counts)) / counts[:, None]
+
+# Batched kernels: same fields as the per-agent functions below, for all agents at once.
+# The dense ones also accept leading batch axes, e.g. (B, N, 2) positions of an ensemble.Ensemble
+def compute_v_des_all(v_field, group_idx, target, center_of_mass, v_max, k_target):
+    v_target = compute_v_target(k_target, target[group_idx], center_of_mass[group_idx])
+    v_des = clip_norm(v_field + v_target, v_max)
+    return(v_target,v_des)
+
+def compute_v_field_all(positions, obstacle_index, diffs, dists, r_rep, k_rep, r_att, k_att, stats=NULL_STATS,
+                        obstacle_field=None):
+    v_rep = compute_v_rep_all(diffs, dists, r_rep, k_rep)
+    v_att = compute_v_att_all(diffs, dists, r_att, k_att)
+    stats.count("pairs", len(dists)*(len(dists)-1))
+    stats.lap("field")
+    v_obst = compute_v_obst_static(positions, obstacle_index, obstacle_field, r_rep, k_rep, stats)
+    stats.lap("obstacles")
+    return v_rep + v_att + v_obst
+
+def compute_v_field_cells(positions, obstacle_index, r_rep, k_rep, r_att, k_att, stats=NULL_STATS, obstacle_field=None):
+    # Pairs within the 3x3 cell block are exact. Beyond it every pair attracts, and
+    # sum (dist - r_att) * diff/dist = sum diff - r_att * sum diff/dist, where sum diff is exact
+    # from cell aggregates and sum diff/dist is the hierarchical approximation of CellList.far_unit_sums
+    n = len(positions)
+    cells = CellList(positions, max(r_rep, r_att))
+    v_rep, v_att = np.zeros((n, 2)), np.zeros((n, 2))
+    for i, j in cells.pairs():
+        diff = positions[j] - positions[i]
+        dist = np.linalg.norm(diff, axis=1)
+        mask = (0 < dist) & (dist < r_rep)
+        coef = np.where(mask, k_rep * (dist - r_rep) / np.where(mask, dist, 1), 0)
+        v_rep += scatter_sum(i, coef[:, None] * diff, n)
+        mask = dist > r_att
+        coef = np.where(mask, k_att/n * (dist - r_att) / np.where(mask, dist, 1), 0)
+        v_att += scatter_sum(i, coef[:, None] * diff, n)
+        stats.count("pairs", len(i))
+    block_sums, block_counts = cells.block_aggregates()
+    far_diffs = (positions.sum(axis=0) - block_sums) - (n - block_counts)[:, None] * positions
+    v_att += k_att/n * (far_diffs - r_att * cells.far_unit_sums())
+    stats.lap("field")
+    v_obst = compute_v_obst_static(positions, obstacle_index, obstacle_field, r_rep, k_rep, stats)
+    stats.lap("obstacles")
+    return v_rep + v_att + v_obst
+
+def scatter_sum(idx, values, n):
+    return np.stack([np.bincount(idx, weights=values[:, k], minlength=n) for k in range(2)], axis=1)
+
+def clip_norm(v, v_max):
+    norm = np.linalg.norm(v, axis=-1, keepdims=True)
+    scale = np.minimum(norm, v_max) / np.where(norm > 0, norm, 1)
+    return v * scale
+
+def compute_v_rep_all(diffs, dists, r_rep, k_rep):
+    mask = (0 < dists) & (dists < r_rep)
+    coef = np.where(mask, k_rep * (dists - r_rep) / np.where(mask, dists, 1), 0)
+    return np.sum(coef[..., None] * diffs, axis=-2)
+
+def compute_v_att_all(diffs, dists, r_att, k_att):
+    n = dists.shape[-1]
+    mask = dists > r_att
+    coef = np.where(mask, k_att/n * (dists - r_att) / np.where(mask, dists, 1), 0)
+    return np.sum(coef[..., None] * diffs, axis=-2)
+
+def compute_v_obst_all(positions, obstacle_bounds, r_rep, k_rep, valid=None):
+    """ valid (..., M) masks out padding rows of obstacle_bounds """
+    if not obstacle_bounds.shape[-2]:
+        return np.zeros_like(positions)
+    closest = closest_points(positions, obstacle_bounds)  # (..., N, M, 2)
+    diff = closest - positions[..., :, None, :]
+    dist = np.linalg.norm(diff, axis=-1)
+    mask = (0 < dist) & (dist < r_rep)
+    if valid is not None:
+        mask &= valid[..., None, :]
+    coef = np.where(mask, 1.5 * k_rep * (dist - r_rep) / np.where(mask, dist, 1), 0)
+    return np.sum(coef[..., None] * diff, axis=-2)
+
+def get_obstacle_field(map, r_rep):
+    """ With map.field_resolution set, the obstacle repulsion per unit k_rep for r_rep sampled on a grid over the
+        map and a margin of r_rep; built on first use (init_map does it up front) and again when the obstacles
+        or r_rep change. None otherwise """
+    if not map.field_resolution:
+        return None
+    if map.obstacle_field is None or map.obstacle_field.r_rep != r_rep:
+        obstacle_index = map.obstacle_index if map.obstacle_index is not None else map.build_obstacle_index()
+        map.obstacle_field = ObstacleField(map.x_min - r_rep, map.y_min - r_rep, map.x_max + r_rep, map.y_max + r_rep,
+                                           map.field_resolution,
+                                           lambda nodes: compute_v_obst_index(nodes, obstacle_index, r_rep, 1.0))
+        map.obstacle_field.r_rep = r_rep
+    return map.obstacle_field
+
+def compute_v_obst_static(positions, obstacle_index, obstacle_field, r_rep, k_rep, stats=NULL_STATS):
+    """ Bilinear lookup in the precomputed obstacle_field, or the exact repulsion when there is none """
+    if obstacle_field is None:
+        return compute_v_obst_index(positions, obstacle_index, r_rep, k_rep, stats)
+    return k_rep * obstacle_field.lookup(positions)
+
+def obstacle_field_error(map, positions, r_rep=R_REP):
+    """ Max and mean norm of the difference between the field lookup and the exact repulsion at positions,
+        per unit k_rep; the exact repulsion is at most 1.5*r_rep """
+    obstacle_index = map.obstacle_index if map.obstacle_index is not None else map.build_obstacle_index()
+    error = np.linalg.norm(get_obstacle_field(map, r_rep).lookup(positions)
+                           - compute_v_obst_index(positions, obstacle_index, r_rep, 1.0), axis=1)
+    return {"max": float(error.max(initial=0)), "mean": float(error.mean()) if len(error) else 0.0}
+
+def compute_v_obst_index(positions, obstacle_index, r_rep, k_rep, stats=NULL_STATS):
+    i, o = obstacle_index.query_radius(positions, r_rep)
+    stats.count("obstacle_tests", len(i))
+    bounds = obstacle_index.bounds[o]
+    diff = np.clip(positions[i], bounds[:, :2], bounds[:, 2:]) - positions[i]
+    dist = np.linalg.norm(diff, axis=1)
+    mask = 0 < dist
+    coef = np.where(mask, 1.5 * k_rep * (dist - r_rep) / np.where(mask, dist, 1), 0)
+    return scatter_sum(i, coef[:, None] * diff, len(positions))
+
+def closest_points(positions, obstacle_bounds):
+    # !!! WARNING !!! Only works if rectangles are aligned with map
+    lo, hi = obstacle_bounds[..., None, :, :2], obstacle_bounds[..., None, :, 2:]
+    return np.clip(positions[..., :, None, :], lo, hi)
 
 def compute_v_des(i, t_idx, agent_i, all_obstacles, diffs, dists, target, center_of_mass,
                   v_max, r_rep, r_att, k_rep, k_att, k_target):